@@ -2,263 +2,367 @@ import schemas
 import auth
 import logging
 import crud
-
-from database import db
+import database
+import etags
+import events
+import indexes
+import likes
+import metrics
+import roster
+import serialization
+import throttle
+
+from database import db, read_db
 from auth import get_current_active_user
 
-from fastapi import Depends, status, FastAPI, Response, HTTPException
+from cache import user_cache
+from fastapi import Depends, status, FastAPI, Request, Response, HTTPException, Query, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta
+from typing import Union
+import codecs
 
-from schemas import User
+from permissions import Authorizer, get_authorizer
+from schemas import UserPermissions
 import tools
 
-app = FastAPI()
+app = FastAPI(default_response_class=serialization.ORJSONResponse)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.register_stats("user_cache_stats", "Hits, misses and size of the user cache.", user_cache.stats)
+metrics.register_stats("failed_auth_publisher_stats", "Failed login notifications by state.",
+                       tools.failed_auth_publisher.stats)
+metrics.register_stats("events_broker_stats", "Wall event subscriptions and deliveries.", events.broker.stats)
+metrics.register_stats("like_buffer_stats", "Buffered likes and unlikes by state.", likes.buffer.stats)
+metrics.register_stats("login_throttle_stats", "Rejected login attempts and tracked keys.",
+                       throttle.login_throttle.stats)
 logger = logging.getLogger('uvicorn.error')
 
 
+@app.on_event("startup")
+async def open_database():
+    database.connect()
+
+
+@app.on_event("startup")
+async def create_indexes():
+    await indexes.ensure_indexes(db)
+
+
+@app.on_event("startup")
+async def start_failed_auth_publisher():
+    await tools.failed_auth_publisher.start()
+
+
+@app.on_event("shutdown")
+async def stop_failed_auth_publisher():
+    await tools.failed_auth_publisher.stop()
+
+
+@app.on_event("startup")
+async def start_like_buffer():
+    if likes.LIKE_WRITE_BEHIND:
+        await likes.buffer.start(lambda changes: crud.write_buffered_likes(db, changes))
+
+
+@app.on_event("shutdown")
+async def flush_like_buffer():
+    if likes.LIKE_WRITE_BEHIND:
+        await likes.buffer.stop()
+
+
+@app.on_event("startup")
+async def start_events_broker():
+    await events.broker.start()
+
+
+@app.on_event("shutdown")
+async def stop_events_broker():
+    await events.broker.stop()
+
+
+# registered last, so the other shutdown handlers can still write
+@app.on_event("shutdown")
+async def close_database():
+    database.close()
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    client_ip = request.client.host if request.client else None
+    retry_after = await throttle.login_throttle.check(form_data.username, client_ip)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts",
+            headers={"Retry-After": str(retry_after)},
+        )
     user, auth_passed = await auth.authenticate_user(db, form_data.username, form_data.password)
     if not auth_passed:
         if user is not None:
-            await tools.send_failed_auth_message(user)
+            tools.failed_auth_publisher.publish(user)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    await throttle.login_throttle.succeeded(form_data.username, client_ip)
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.get("/courses")
-async def get_courses(current_user: User = Depends(get_current_active_user)):
-    courses = await crud.get_courses(db)
-    return courses
+@app.get("/courses", response_model=list[schemas.Course])
+async def get_courses(request: Request,
+                      current_user: UserPermissions = Depends(get_current_active_user)):
+    etag = etags.make_etag(await crud.get_versions(read_db, [crud.CATALOG_COURSES]))
+    if etags.is_not_modified(request, etag):
+        return etags.not_modified_response(etag)
+    courses = await crud.get_courses(read_db)
+    return serialization.documents_response(courses, etag=etag)
 
 
-@app.get("/classes")
-async def get_courses(current_user: User = Depends(get_current_active_user)):
-    classes = await crud.get_classes(db)
-    return classes
+@app.get("/classes", response_model=list[schemas.Class])
+async def get_classes(request: Request,
+                      current_user: UserPermissions = Depends(get_current_active_user)):
+    etag = etags.make_etag(await crud.get_versions(read_db, [crud.CATALOG_CLASSES]))
+    if etags.is_not_modified(request, etag):
+        return etags.not_modified_response(etag)
+    classes = await crud.get_classes(read_db)
+    return serialization.documents_response(classes, etag=etag)
 
 
-@app.post("/course/{course_id}/post")
+@app.post("/course/{course_id}/post", response_model=schemas.Post)
 async def create_post_in_course(text: str,
                                 course_id: str,
-                                current_user: User = Depends(get_current_active_user)):
-    course_found = False
-
-    for user_course_id in current_user.course_ids:
-        if course_id == user_course_id:
-            course_found = True
-            break
-
-    course = await crud.get_course(db, course_id)
-    if course is None:
-        course_found = False
-
-    if not course_found:
-        raise HTTPException(status_code=400,
-                            detail="Invalid course ID; either does not exist, or user does not have an access")
-    post = await crud.create_post_in_course(db, text, current_user, course)
+                                authorizer: Authorizer = Depends(get_authorizer)):
+    course = await authorizer.member_course(course_id)
+    post = await crud.create_post_in_course(db, text, authorizer.user, course)
     return post
 
 
-@app.post("/class/{class_id}/post")
+@app.post("/class/{class_id}/post", response_model=schemas.Post)
 async def create_post_in_class(text: str,
                                 class_id: str,
-                                current_user: User = Depends(get_current_active_user)):
-    class_found = False
-
-    for user_class_id in current_user.class_ids:
-        if class_id == user_class_id:
-            class_found = True
-            break
-
-    a_class = await crud.get_class(db, class_id)
-    if a_class is None:
-        class_found = False
-
-    if not class_found:
-        raise HTTPException(status_code=400,
-                            detail="Invalid class ID; either does not exist, or user does not have an access")
-    post = await crud.create_post_in_class(db, text, current_user, a_class)
+                                authorizer: Authorizer = Depends(get_authorizer)):
+    a_class = await authorizer.member_class(class_id)
+    post = await crud.create_post_in_class(db, text, authorizer.user, a_class)
     return post
 
 
-@app.get("/course/{course_id}/wall")
-async def get_wall_for_course(course_id: str,
-                             current_user: User = Depends(get_current_active_user)):
-    if course_id not in current_user.course_ids:
-        raise HTTPException(status_code=400,
-                            detail="Invalid course ID; either does not exist, or user does not have an access")
-    posts = await crud.get_posts_for_course(db, course_id)
-    return posts
-
-
-@app.get("/class/{class_id}/wall")
-async def get_wall_for_class(class_id: str,
-                             current_user: User = Depends(get_current_active_user)):
-    if class_id not in current_user.class_ids:
-        raise HTTPException(status_code=400,
-                            detail="Invalid class ID; either does not exist, or user does not have an access")
-    posts = await crud.get_posts_for_class(db, class_id)
-    return posts
-
-
-@app.get("/user/info")
-async def user_info(current_user: User = Depends(get_current_active_user)):
-    user = schemas.UserPermissions(**dict(current_user))
-    return user
-
-
-@app.delete("/post/post_id}")
+@app.get("/course/{course_id}/wall", response_model=list[schemas.Post])
+async def get_wall_for_course(request: Request,
+                              course_id: str,
+                              limit: int = Query(default=crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                              after: Union[str, None] = None,
+                              authorizer: Authorizer = Depends(get_authorizer)):
+    authorizer.check_course_member(course_id)
+    etag = etags.make_etag(await crud.get_versions(read_db, [course_id]), limit, after)
+    if etags.is_not_modified(request, etag):
+        return etags.not_modified_response(etag)
+    posts, next_cursor = await crud.get_posts_for_course(read_db, course_id, limit, after)
+    return serialization.documents_response(posts, next_cursor, etag)
+
+
+@app.get("/class/{class_id}/wall", response_model=list[schemas.Post])
+async def get_wall_for_class(request: Request,
+                             class_id: str,
+                             limit: int = Query(default=crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                             after: Union[str, None] = None,
+                             authorizer: Authorizer = Depends(get_authorizer)):
+    authorizer.check_class_member(class_id)
+    etag = etags.make_etag(await crud.get_versions(read_db, [class_id]), limit, after)
+    if etags.is_not_modified(request, etag):
+        return etags.not_modified_response(etag)
+    posts, next_cursor = await crud.get_posts_for_class(read_db, class_id, limit, after)
+    return serialization.documents_response(posts, next_cursor, etag)
+
+
+@app.get("/course/{course_id}/export", response_class=StreamingResponse)
+async def export_course_wall(course_id: str,
+                             authorizer: Authorizer = Depends(get_authorizer)):
+    authorizer.check_course_member(course_id)
+    authorizer.require_teacher("Only teachers can export walls")
+    posts = crud.iter_posts_with_comments(read_db, {'course_id': course_id})
+    return serialization.ndjson_response(posts, f"course-{course_id}.ndjson")
+
+
+@app.get("/class/{class_id}/export", response_class=StreamingResponse)
+async def export_class_wall(class_id: str,
+                            authorizer: Authorizer = Depends(get_authorizer)):
+    authorizer.check_class_member(class_id)
+    authorizer.require_teacher("Only teachers can export walls")
+    posts = crud.iter_posts_with_comments(read_db, {'class_id': class_id})
+    return serialization.ndjson_response(posts, f"class-{class_id}.ndjson")
+
+
+@app.get("/events", response_class=StreamingResponse)
+async def wall_events(current_user: UserPermissions = Depends(get_current_active_user)):
+    stream = events.event_stream(events.broker, current_user.course_ids + current_user.class_ids)
+    return StreamingResponse(stream, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/user/info", response_model=UserPermissions)
+async def user_info(current_user: UserPermissions = Depends(get_current_active_user)):
+    return current_user
+
+
+@app.delete("/post/{post_id}", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def remove_post(post_id: str,
-                      current_user: User = Depends(get_current_active_user)):
-    post = await crud.get_post(db, post_id)
+                      authorizer: Authorizer = Depends(get_authorizer)):
+    post = await authorizer.deletable_post(post_id)
     logger.info(post)
-    if post is None:
-        raise HTTPException(status_code=400, detail="Invalid post ID")
-    elif post.author_id != str(current_user.id) and \
-       (not current_user.is_teacher or
-       (str(post.class_id) not in current_user.class_ids and
-       str(post.course_id) not in current_user.course_ids)):
-        raise HTTPException(status_code=403,
-                            detail="User does not have permissions to delete this post")
 
     await crud.remove_post(db, post)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
-@app.get("/wall")
-async def get_wall(current_user: User = Depends(get_current_active_user)):
-    posts = []
-    for class_id in current_user.class_ids:
-        posts += await crud.get_posts_for_class(db, class_id)
-    for course_id in current_user.course_ids:
-        posts += await crud.get_posts_for_course(db, course_id)
-    return posts
-
-
-@app.post("/post/{post_id}/like")
+@app.get("/wall", response_model=list[schemas.Post])
+async def get_wall(request: Request,
+                   limit: int = Query(default=crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                   after: Union[str, None] = None,
+                   current_user: UserPermissions = Depends(get_current_active_user)):
+    scope_ids = sorted(current_user.course_ids + current_user.class_ids)
+    etag = etags.make_etag(scope_ids, await crud.get_versions(read_db, scope_ids), limit, after)
+    if etags.is_not_modified(request, etag):
+        return etags.not_modified_response(etag)
+    if crud.WALL_TIMELINES:
+        posts, next_cursor = await crud.get_timeline_wall(db, current_user, limit, after)
+    else:
+        posts, next_cursor = await crud.get_wall(read_db, current_user, limit, after)
+    return serialization.documents_response(posts, next_cursor, etag)
+
+
+@app.get("/search", response_model=list[schemas.SearchResult])
+async def search(q: str = Query(min_length=1, max_length=200),
+                 limit: int = Query(default=crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                 after: Union[str, None] = None,
+                 current_user: UserPermissions = Depends(get_current_active_user)):
+    try:
+        cursor = None if after is None else crud.parse_search_cursor(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    results, next_cursor = await crud.search_posts_and_comments(read_db, current_user, q, limit, cursor)
+    return serialization.documents_response(results, next_cursor)
+
+
+@app.post("/post/{post_id}/like", response_model=schemas.Post)
 async def like_post(post_id: str,
-                    current_user: User = Depends(get_current_active_user)):
-    post = await crud.get_post(db, post_id)
-    if post is None:
+                    authorizer: Authorizer = Depends(get_authorizer)):
+    post = await authorizer.accessible_post(post_id)
+    try:
+        post = await crud.like_post(db, post, authorizer.user)
+    except crud.TargetDeleted:
         raise HTTPException(status_code=400, detail="Invalid post ID")
-    elif post.author_id != str(current_user.id) and \
-       str(post.class_id) not in current_user.class_ids and \
-       str(post.course_id) not in current_user.course_ids:
-        raise HTTPException(status_code=403,
-                            detail="User does not have an access to given post")
-    elif str(current_user.id) in post.likes_user_ids:
+    if post is None:
         raise HTTPException(status_code=400, detail="User already liked this post")
-    _, post = await crud.like_post(db, post, current_user)
     return post
 
 
-@app.delete("/post/{post_id}/like")
+@app.delete("/post/{post_id}/like", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def remove_like_from_post(post_id: str,
-                    current_user: User = Depends(get_current_active_user)):
-    post = await crud.get_post(db, post_id)
-    if post is None:
+                    authorizer: Authorizer = Depends(get_authorizer)):
+    post = await authorizer.accessible_post(post_id)
+    try:
+        updated_post = await crud.remove_like_from_post(db, post, authorizer.user)
+    except crud.TargetDeleted:
         raise HTTPException(status_code=400, detail="Invalid post ID")
-    elif post.author_id != str(current_user.id) and \
-         str(post.class_id) not in current_user.class_ids and \
-         str(post.course_id) not in current_user.course_ids:
-        raise HTTPException(status_code=403,
-                            detail="User does not have an access to given post")
-    elif str(current_user.id) not in post.likes_user_ids:
+    if updated_post is None:
         raise HTTPException(status_code=400, detail="User has not liked this post")
-    await crud.remove_like_from_post(db, post, current_user)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
-@app.post("/post/{post_id}/comment")
+@app.post("/post/{post_id}/comment", response_model=schemas.Comment)
 async def add_comment(text: str,
                       post_id: str,
-                      current_user: User = Depends(get_current_active_user)):
-    post = await crud.get_post(db, post_id)
-    if post is None:
-        raise HTTPException(status_code=400, detail="Invalid post ID")
-    elif post.author_id != str(current_user.id) and \
-         str(post.class_id) not in current_user.class_ids and \
-         str(post.course_id) not in current_user.course_ids:
-        raise HTTPException(status_code=403,
-                            detail="User does not have an access to given post")
-    comment = await crud.create_comment(db, text, post, current_user)
+                      authorizer: Authorizer = Depends(get_authorizer)):
+    post = await authorizer.accessible_post(post_id)
+    comment = await crud.create_comment(db, text, post, authorizer.user)
     return comment
 
 
-@app.get("/post/{post_id}/comments")
+@app.get("/post/{post_id}/comments", response_model=list[schemas.Comment])
 async def get_comments(post_id: str,
-                       current_user: User = Depends(get_current_active_user)):
-    post = await crud.get_post(db, post_id)
-    if post is None:
-        raise HTTPException(status_code=400, detail="Invalid post ID")
-    elif post.author_id != str(current_user.id) and \
-         str(post.class_id) not in current_user.class_ids and \
-         str(post.course_id) not in current_user.course_ids:
-        raise HTTPException(status_code=403,
-                            detail="User does not have an access to given post")
+                       limit: int = Query(default=crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                       after: Union[str, None] = None,
+                       authorizer: Authorizer = Depends(get_authorizer)):
+    post = await authorizer.accessible_post(post_id)
 
-    comments = await crud.get_comments_for_post(db, post)
-    return comments
+    comments, next_cursor = await crud.get_comments_for_post(read_db, post, limit, after)
+    return serialization.documents_response(comments, next_cursor)
 
 
-@app.delete("/comment/{comment_id}")
+@app.get("/post/{post_id}/thread", response_model=schemas.PostThread)
+async def get_thread(post_id: str,
+                     limit: int = Query(default=crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+                     authorizer: Authorizer = Depends(get_authorizer)):
+    thread, next_cursor = await crud.get_thread(read_db, post_id, limit)
+    if thread is None:
+        raise HTTPException(status_code=400, detail="Invalid post ID")
+    authorizer.check_post_access(schemas.PostAccess(**thread))
+    return serialization.documents_response(thread, next_cursor)
+
+
+@app.delete("/comment/{comment_id}", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def remove_comment(comment_id: str,
-                         current_user: User = Depends(get_current_active_user)):
-    comment = await crud.get_comment(db, comment_id)
-    if comment is None:
-        raise HTTPException(status_code=400, detail="Invalid comment ID")
-    post = await crud.get_post(db, comment.post_id)
-    if comment.author_id != str(current_user.id) and \
-        str(post.class_id) not in current_user.class_ids and \
-        str(post.course_id) not in current_user.course_ids:
-        raise HTTPException(status_code=403,
-                            detail="User does not have an access to the given comment")
+                         authorizer: Authorizer = Depends(get_authorizer)):
+    comment, post = await authorizer.accessible_comment(comment_id)
 
     await crud.remove_comment(db, comment)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
-@app.post("/comment/{comment_id}/like")
+@app.post("/comment/{comment_id}/like", response_model=schemas.Comment)
 async def like_comment(comment_id: str,
-                       current_user: User = Depends(get_current_active_user)):
-    comment = await crud.get_comment(db, comment_id)
-    if comment is None:
+                       authorizer: Authorizer = Depends(get_authorizer)):
+    comment, post = await authorizer.accessible_comment(comment_id)
+    try:
+        comment = await crud.like_comment(db, comment, post, authorizer.user)
+    except crud.TargetDeleted:
         raise HTTPException(status_code=400, detail="Invalid comment ID")
-    post = await crud.get_post(db, comment.post_id)
-    if comment.author_id != str(current_user.id) and \
-        str(post.class_id) not in current_user.class_ids and \
-        str(post.course_id) not in current_user.course_ids:
-        raise HTTPException(status_code=403,
-                            detail="User does not have an access to the given comment")
-    if str(current_user.id) in comment.likes_user_ids:
+    if comment is None:
         raise HTTPException(status_code=400, detail="User already liked this comment")
-    _, comment = await crud.like_comment(db, comment, current_user)
     return comment
 
 
-@app.delete("/comment/{comment_id}/like")
+@app.delete("/comment/{comment_id}/like", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def remove_like_from_comment(comment_id: str,
-                                   current_user: User = Depends(get_current_active_user)):
-    comment = await crud.get_comment(db, comment_id)
-    if comment is None:
+                                   authorizer: Authorizer = Depends(get_authorizer)):
+    comment, post = await authorizer.accessible_comment(comment_id)
+    try:
+        updated_comment = await crud.remove_like_from_comment(db, comment, post, authorizer.user)
+    except crud.TargetDeleted:
         raise HTTPException(status_code=400, detail="Invalid comment ID")
-    post = await crud.get_post(db, comment.post_id)
-    if comment.author_id != str(current_user.id) and \
-        str(post.class_id) not in current_user.class_ids and \
-        str(post.course_id) not in current_user.course_ids:
-        raise HTTPException(status_code=403,
-                            detail="User does not have an access to the given comment")
-    if str(current_user.id) not in comment.likes_user_ids:
+    if updated_comment is None:
         raise HTTPException(status_code=400, detail="User has not liked this comment")
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@app.get("/likes/posts", response_model=list[str])
+async def get_liked_posts(post_ids: list[str] = Query(default=[], max_items=crud.MAX_PAGE_SIZE),
+                          current_user: UserPermissions = Depends(get_current_active_user)):
+    liked_post_ids = await crud.get_liked_ids(db, current_user, crud.LIKE_POST, post_ids)
+    return liked_post_ids
+
+
+@app.get("/likes/comments", response_model=list[str])
+async def get_liked_comments(comment_ids: list[str] = Query(default=[], max_items=crud.MAX_PAGE_SIZE),
+                             current_user: UserPermissions = Depends(get_current_active_user)):
+    liked_comment_ids = await crud.get_liked_ids(db, current_user, crud.LIKE_COMMENT, comment_ids)
+    return liked_comment_ids
+
 
-    await crud.remove_like_from_comment(db, comment, current_user)
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+@app.post("/admin/roster", response_model=schemas.RosterImportReport)
+async def import_roster(file: UploadFile,
+                        authorizer: Authorizer = Depends(get_authorizer)):
+    if authorizer.user.username not in roster.ROSTER_ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Only roster administrators can import rosters")
+    # SpooledTemporaryFile cannot be wrapped in a TextIOWrapper before Python 3.11
+    report = await roster.import_roster(db, codecs.iterdecode(file.file, "utf-8"), importer=authorizer.user.username)
+    return report
@@ -1,10 +1,12 @@
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from crud import get_user, pwd_context
+from crud import get_user
+from passwords import verify_password
 from fastapi import Depends, status, HTTPException
-from schemas import TokenData, User
+from schemas import TokenData, UserCredentials, UserPermissions
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from database import db
+from cache import user_cache
 import os
 
 
@@ -17,19 +19,11 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-
 async def authenticate_user(db, username: str, password: str):
-    user = await get_user(db, username)
+    user = await get_user(db, username, model=UserCredentials)
     if not user:
         return None, False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return user, False
     return user, True
 
@@ -59,14 +53,17 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = await get_user(db, username=token_data.username)
+    user = await user_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
+        user = await get_user(db, username=token_data.username, model=UserPermissions)
+        if user is None:
+            raise credentials_exception
+        await user_cache.set(user.username, user)
     return user
 
 
 async def get_current_active_user(
-    current_user: User = Depends(get_current_user)
+    current_user: UserPermissions = Depends(get_current_user)
 ):
     #if current_user.disabled:
     #    raise HTTPException(status_code=400, detail="Inactive user")
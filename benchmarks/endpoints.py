@@ -0,0 +1,267 @@
+"""Latency, throughput and database round trips of every route in api.py.
+
+By default the application runs against the in-memory fake from
+`benchmarks.fake_motor`; with `--mongodb` it uses a real server instead (the
+benchmark database is dropped and filled with synthetic data first) and round
+trips are counted with a pymongo command listener.
+
+    python -m benchmarks.endpoints --output results.json
+    python -m benchmarks.endpoints --check benchmarks/baseline.json
+    python -m benchmarks.endpoints --write-baseline benchmarks/baseline.json
+
+`--check` fails when any endpoint needs more round trips per request than the
+baseline records. Latency numbers depend on the machine and are only reported.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from argparse import Namespace
+
+import httpx
+from pymongo import monitoring
+
+import database
+from benchmarks.fake_motor import FakeDatabase
+
+
+PASSWORD = "benchmark"
+
+
+class CommandCounter(monitoring.CommandListener):
+
+    def __init__(self):
+        self.round_trips = 0
+
+    def started(self, event):
+        self.round_trips += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def percentile(values: list[float], q: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+def connect(mongodb: str):
+    if mongodb is None:
+        db = FakeDatabase()
+        return db, db
+    import motor.motor_asyncio
+
+    counter = CommandCounter()
+    client = motor.motor_asyncio.AsyncIOMotorClient(mongodb, event_listeners=[counter])
+    return client.pa200benchmark, counter
+
+
+class Benchmark:
+
+    def __init__(self, client: httpx.AsyncClient, counter, iterations: int):
+        self.client = client
+        self.counter = counter
+        self.iterations = iterations
+        self.headers = None
+        self.results = {}
+
+    async def log_in(self, username: str):
+        response = await self.client.post("/token", data={"username": username, "password": PASSWORD})
+        response.raise_for_status()
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def request(self, method: str, url: str, expected_status: int = 200, headers: dict = None, **kwargs):
+        response = await self.client.request(method, url, headers={**(self.headers or {}), **(headers or {})},
+                                             **kwargs)
+        if response.status_code != expected_status:
+            raise RuntimeError(f"{method} {url} returned {response.status_code}: {response.text}")
+        return response
+
+    async def measure(self, name: str, method: str, url_for, expected_status: int = 200, **kwargs):
+        # the first request warms up caches and is not measured
+        responses = [await self.request(method, url_for(0), expected_status, **kwargs)]
+        latencies = []
+        round_trips_before = self.counter.round_trips
+        start = time.perf_counter()
+        for iteration in range(1, self.iterations + 1):
+            request_start = time.perf_counter()
+            responses.append(await self.request(method, url_for(iteration), expected_status, **kwargs))
+            latencies.append((time.perf_counter() - request_start) * 1000)
+        seconds = time.perf_counter() - start
+        self.results[name] = {
+            "round_trips": round((self.counter.round_trips - round_trips_before) / self.iterations, 2),
+            "p50_ms": round(percentile(latencies, 0.5), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "requests_per_second": round(self.iterations / seconds, 1),
+        }
+        return responses
+
+    async def measure_burst(self, name: str, method: str, url: str, requests: int, **kwargs):
+        """Sends all requests at once, as a credential stuffing burst would, and returns their status codes."""
+        async def timed_request():
+            request_start = time.perf_counter()
+            response = await self.client.request(method, url, headers=self.headers, **kwargs)
+            latencies.append((time.perf_counter() - request_start) * 1000)
+            return response.status_code
+
+        latencies = []
+        round_trips_before = self.counter.round_trips
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(timed_request() for _ in range(requests)))
+        seconds = time.perf_counter() - start
+        self.results[name] = {
+            "round_trips": round((self.counter.round_trips - round_trips_before) / requests, 2),
+            "p50_ms": round(percentile(latencies, 0.5), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "requests_per_second": round(requests / seconds, 1),
+        }
+        return statuses
+
+
+async def run(db, counter, args):
+    import api
+    import crud
+    import populate_db
+    import roster
+    import throttle
+
+    await populate_db.populate_db(db, Namespace(
+        users=args.users, teachers=1, classes=2, courses=4, courses_per_user=2,
+        posts_per_wall=args.posts_per_wall, comments_per_post=3, max_likes_per_post=20, max_likes_per_comment=5,
+        likes_zipf_exponent=2.0, days=30, password=PASSWORD, seed=42, batch_size=1000, concurrency=4, drop=True))
+    teacher = await crud.get_user(db, "user1@example.com")
+    roster.ROSTER_ADMIN_USERNAMES.add(teacher.username)
+    course_id = teacher.course_ids[0]
+    class_id = teacher.class_ids[0]
+    posts, _ = await crud.get_posts_for_course(db, course_id, limit=1)
+    post_id = str(posts[0]["_id"])
+
+    await api.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            benchmark = Benchmark(client, counter, args.iterations)
+            await benchmark.measure("POST /token", "POST", lambda i: "/token",
+                                    data={"username": teacher.username, "password": PASSWORD})
+            await benchmark.log_in(teacher.username)
+
+            await benchmark.measure("GET /courses", "GET", lambda i: "/courses")
+            await benchmark.measure("GET /classes", "GET", lambda i: "/classes")
+            await benchmark.measure("GET /user/info", "GET", lambda i: "/user/info")
+            await benchmark.measure("GET /wall", "GET", lambda i: "/wall")
+            await benchmark.measure("GET /course/{course_id}/wall", "GET", lambda i: f"/course/{course_id}/wall")
+            await benchmark.measure("GET /class/{class_id}/wall", "GET", lambda i: f"/class/{class_id}/wall")
+            for name, url in (("GET /courses", "/courses"), ("GET /wall", "/wall"),
+                              ("GET /course/{course_id}/wall", f"/course/{course_id}/wall")):
+                etag = (await benchmark.request("GET", url)).headers["ETag"]
+                await benchmark.measure(f"{name} (not modified)", "GET", lambda i: url, expected_status=304,
+                                        headers={"If-None-Match": etag})
+            await benchmark.measure("GET /post/{post_id}/comments", "GET", lambda i: f"/post/{post_id}/comments")
+            await benchmark.measure("GET /post/{post_id}/thread", "GET", lambda i: f"/post/{post_id}/thread")
+            await benchmark.measure("GET /course/{course_id}/export", "GET", lambda i: f"/course/{course_id}/export")
+            await benchmark.measure("GET /search", "GET", lambda i: "/search?q=comment")
+
+            responses = await benchmark.measure("POST /course/{course_id}/post", "POST",
+                                                lambda i: f"/course/{course_id}/post?text=Benchmark+{i}")
+            course_post_ids = [response.json()["_id"] for response in responses]
+            responses = await benchmark.measure("POST /class/{class_id}/post", "POST",
+                                                lambda i: f"/class/{class_id}/post?text=Benchmark+{i}")
+            class_post_ids = [response.json()["_id"] for response in responses]
+
+            await benchmark.measure("POST /post/{post_id}/like", "POST",
+                                    lambda i: f"/post/{course_post_ids[i]}/like")
+            await benchmark.measure("DELETE /post/{post_id}/like", "DELETE",
+                                    lambda i: f"/post/{course_post_ids[i]}/like", expected_status=204)
+            await benchmark.measure("GET /likes/posts", "GET",
+                                    lambda i: "/likes/posts?" + "&".join(f"post_ids={id}" for id in course_post_ids))
+
+            responses = await benchmark.measure("POST /post/{post_id}/comment", "POST",
+                                                lambda i: f"/post/{post_id}/comment?text=Benchmark+{i}")
+            comment_ids = [response.json()["_id"] for response in responses]
+            await benchmark.measure("POST /comment/{comment_id}/like", "POST",
+                                    lambda i: f"/comment/{comment_ids[i]}/like")
+            await benchmark.measure("DELETE /comment/{comment_id}/like", "DELETE",
+                                    lambda i: f"/comment/{comment_ids[i]}/like", expected_status=204)
+            await benchmark.measure("GET /likes/comments", "GET",
+                                    lambda i: "/likes/comments?" + "&".join(f"comment_ids={id}" for id in comment_ids))
+            await benchmark.measure("DELETE /comment/{comment_id}", "DELETE",
+                                    lambda i: f"/comment/{comment_ids[i]}", expected_status=204)
+
+            await benchmark.measure("DELETE /post/{post_id}", "DELETE",
+                                    lambda i: f"/post/{class_post_ids[i]}", expected_status=204)
+
+            roster_csv = f"username,password,is_teacher,course_ids,class_ids\nbenchmark@example.com,x,false,{course_id},\n"
+            await benchmark.measure("POST /admin/roster", "POST", lambda i: "/admin/roster",
+                                    files={"file": ("roster.csv", roster_csv.encode())})
+            await benchmark.measure("GET /metrics", "GET", lambda i: "/metrics")
+
+            # only the attempts within the username limit may reach the database and bcrypt
+            statuses = await benchmark.measure_burst("POST /token (wrong password burst)", "POST", "/token", 60,
+                                                     data={"username": "user2@example.com", "password": "wrong"})
+            failed = statuses.count(401)
+            if failed > throttle.login_throttle.username_limit or failed + statuses.count(429) != len(statuses):
+                raise RuntimeError(f"POST /token burst: {failed} failed logins, limit "
+                                   f"{throttle.login_throttle.username_limit}, statuses {sorted(set(statuses))}")
+    finally:
+        await api.app.router.shutdown()
+    return benchmark.results
+
+
+def check(results: dict, baseline: dict):
+    regressions = []
+    for name, expected in baseline.items():
+        if name not in results:
+            regressions.append(f"{name}: missing from the results")
+        elif results[name]["round_trips"] > expected["round_trips"]:
+            regressions.append(f"{name}: {results[name]['round_trips']} round trips, "
+                               f"baseline {expected['round_trips']}")
+    return regressions
+
+
+def main(args):
+    db, counter = connect(args.mongodb)
+    # every module reads `database.db` and `database.read_db` when it is imported, so they have to be replaced first
+    database.db = database.read_db = db
+    results = asyncio.run(run(db, counter, args))
+
+    print(f"{'endpoint':<48}{'round trips':>12}{'p50 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+    for name, result in results.items():
+        print(f"{name:<48}{result['round_trips']:>12}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['requests_per_second']:>10.1f}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.write_baseline:
+        with open(args.write_baseline, "w") as output:
+            json.dump({name: {"round_trips": result["round_trips"]} for name, result in results.items()},
+                      output, indent=2)
+            output.write("\n")
+    if args.check:
+        with open(args.check) as baseline_file:
+            regressions = check(results, json.load(baseline_file))
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongodb", help="connection string of a MongoDB server; the in-memory fake if omitted")
+    parser.add_argument("--iterations", type=int, default=50, help="measured requests per endpoint")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--posts-per-wall", type=int, default=200)
+    parser.add_argument("--output", help="write all results as JSON to this file")
+    parser.add_argument("--write-baseline", help="write the round trips per endpoint as JSON to this file")
+    parser.add_argument("--check", help="compare the round trips with this baseline file")
+    os.environ.setdefault("HASH_SECRET", "benchmark")
+    os.environ.setdefault("FAILED_AUTH_TRANSPORT", "memory")
+    sys.exit(main(parser.parse_args()))
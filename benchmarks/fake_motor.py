@@ -0,0 +1,550 @@
+"""In-memory stand-in for the parts of Motor the application uses.
+
+Every awaited operation counts as one database round trip, the same way each of
+them is one command sent to a real server, so benchmarks can report how many
+round trips an endpoint needs without running `mongod`.
+"""
+import copy
+import re
+from collections import defaultdict
+
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+
+DUPLICATE_KEY_ERROR = 11000
+DEFAULT_BATCH_SIZE = 101
+MISSING = object()
+
+
+def get_path(document, path: str):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return MISSING
+    return value
+
+
+def sort_key(value):
+    if value is MISSING or value is None:
+        return (0, "")
+    if isinstance(value, bool):
+        return (3, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (4, str(value))
+
+
+def compare(value, operator: str, operand):
+    if value is MISSING or value is None or operand is None:
+        return False
+    if sort_key(value)[0] != sort_key(operand)[0]:
+        return False
+    if operator == "$lt":
+        return value < operand
+    if operator == "$lte":
+        return value <= operand
+    if operator == "$gt":
+        return value > operand
+    return value >= operand
+
+
+def equals(value, operand):
+    if operand is None:
+        return value is MISSING or value is None
+    if isinstance(value, list) and not isinstance(operand, list):
+        return operand in value
+    return value == operand
+
+
+def match_condition(value, condition):
+    if not isinstance(condition, dict) or not any(key.startswith("$") for key in condition):
+        return equals(value, condition)
+    for operator, operand in condition.items():
+        if operator == "$in":
+            if not any(equals(value, item) for item in operand):
+                return False
+        elif operator == "$nin":
+            if any(equals(value, item) for item in operand):
+                return False
+        elif operator == "$ne":
+            if equals(value, operand):
+                return False
+        elif operator == "$exists":
+            if (value is not MISSING) != bool(operand):
+                return False
+        elif operator in ("$lt", "$lte", "$gt", "$gte"):
+            values = value if isinstance(value, list) else [value]
+            if not any(compare(item, operator, operand) for item in values):
+                return False
+        else:
+            raise NotImplementedError(f"Query operator {operator} is not supported")
+    return True
+
+
+def text_score(document: dict, search: str):
+    # a rough stand-in for a text index on `text`: words match by prefix, and any negated word excludes
+    words = re.findall(r"\w+", str(document.get("text", "")).lower())
+    score = 0.0
+    for term in re.findall(r"-?\w+", search.lower()):
+        count = sum(1 for word in words if word.startswith(term.lstrip("-")))
+        if term.startswith("-") and count:
+            return 0.0
+        if not term.startswith("-"):
+            score += count / (1 + len(words) / 10)
+    return score
+
+
+def matches(document: dict, query: dict):
+    for key, condition in (query or {}).items():
+        if key == "$text":
+            if not text_score(document, condition["$search"]):
+                return False
+        elif key == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, clause) for clause in condition):
+                return False
+        elif not match_condition(get_path(document, key), condition):
+            return False
+    return True
+
+
+def project(document: dict, projection):
+    if not projection:
+        return copy.deepcopy(document)
+    included = {key for key, value in projection.items() if value and key != "_id"}
+    if included:
+        result = {key: copy.deepcopy(document[key]) for key in included if key in document}
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+    return {key: copy.deepcopy(value) for key, value in document.items() if projection.get(key, 1)}
+
+
+def sort_documents(documents: list[dict], sort):
+    for key, direction in reversed(sort):
+        documents.sort(key=lambda document: sort_key(get_path(document, key)), reverse=direction < 0)
+    return documents
+
+
+def normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+def set_path(document: dict, path: str, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def unset_path(document: dict, path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part, {})
+    document.pop(parts[-1], None)
+
+
+def evaluate_expression(expression, document: dict, variables: dict = None):
+    if isinstance(expression, str) and expression.startswith("$$"):
+        return variables[expression[2:]]
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_path(document, expression[1:])
+        return None if value is MISSING else value
+    if not (isinstance(expression, dict) and len(expression) == 1 and next(iter(expression)).startswith("$")):
+        return expression
+    (operator, operand), = expression.items()
+    if operator == "$filter":
+        return [item for item in evaluate_expression(operand["input"], document, variables)
+                if evaluate_expression(operand["cond"], document, {**(variables or {}), "this": item})]
+    arguments = [evaluate_expression(argument, document, variables)
+                 for argument in (operand if isinstance(operand, list) else [operand])]
+    if operator == "$max":
+        values = [value for value in arguments if value is not None]
+        return max(values, key=sort_key) if values else None
+    if operator == "$arrayElemAt":
+        items, index = arguments
+        return items[index] if -len(items) <= index < len(items) else None
+    if operator == "$ne":
+        return arguments[0] != arguments[1]
+    raise NotImplementedError(f"Expression operator {operator} is not supported")
+
+
+def apply_update(document: dict, update, inserting: bool = False):
+    if isinstance(update, list):
+        # an update with an aggregation pipeline
+        for stage in update:
+            (operator, fields), = stage.items()
+            if operator not in ("$set", "$addFields"):
+                raise NotImplementedError(f"Update stage {operator} is not supported")
+            values = {path: evaluate_expression(expression, document) for path, expression in fields.items()}
+            for path, value in values.items():
+                set_path(document, path, copy.deepcopy(value))
+        return
+    for operator, fields in update.items():
+        for path, operand in fields.items():
+            current = get_path(document, path)
+            if operator == "$set":
+                set_path(document, path, copy.deepcopy(operand))
+            elif operator == "$setOnInsert":
+                if inserting:
+                    set_path(document, path, copy.deepcopy(operand))
+            elif operator == "$unset":
+                unset_path(document, path)
+            elif operator == "$max":
+                if current is MISSING or current is None or sort_key(operand) > sort_key(current):
+                    set_path(document, path, copy.deepcopy(operand))
+            elif operator == "$inc":
+                set_path(document, path, (0 if current is MISSING else current) + operand)
+            elif operator in ("$addToSet", "$push"):
+                items = current if isinstance(current, list) else []
+                each = operand["$each"] if isinstance(operand, dict) and "$each" in operand else [operand]
+                for item in each:
+                    if operator == "$push" or item not in items:
+                        items.append(copy.deepcopy(item))
+                if isinstance(operand, dict) and "$sort" in operand:
+                    if isinstance(operand["$sort"], dict):
+                        sort_documents(items, normalize_sort(operand["$sort"]))
+                    else:
+                        items.sort(key=sort_key, reverse=operand["$sort"] < 0)
+                if isinstance(operand, dict) and "$slice" in operand:
+                    limit = operand["$slice"]
+                    items = items[limit:] if limit < 0 else items[:limit]
+                set_path(document, path, items)
+            elif operator == "$pull":
+                if isinstance(current, list):
+                    set_path(document, path, [item for item in current
+                                              if not (matches(item, operand) if isinstance(operand, dict)
+                                                      and isinstance(item, dict)
+                                                      else match_condition(item, operand))])
+            else:
+                raise NotImplementedError(f"Update operator {operator} is not supported")
+
+
+class FakeCursor:
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_spec = []
+        self.skip_count = 0
+        self.limit_count = 0
+        self.batch_count = DEFAULT_BATCH_SIZE
+        self.results = None
+        self.position = 0
+
+    def sort(self, key_or_list, direction=None):
+        self.sort_spec = normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, count: int):
+        self.skip_count = count
+        return self
+
+    def limit(self, count: int):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, count: int):
+        self.batch_count = count
+        return self
+
+    def evaluate(self):
+        documents = [document for document in self.collection.documents.values() if matches(document, self.query)]
+        sort_documents(documents, self.sort_spec)
+        documents = documents[self.skip_count:]
+        if self.limit_count:
+            documents = documents[:self.limit_count]
+        return [project(document, self.projection) for document in documents]
+
+    async def to_list(self, length=None):
+        # like Motor, repeated calls continue where the previous one stopped
+        self.collection.database.count_round_trip()
+        if self.results is None:
+            self.results = self.evaluate()
+        end = len(self.results) if length is None else self.position + length
+        documents = self.results[self.position:end]
+        self.position += len(documents)
+        return documents
+
+    def __aiter__(self):
+        self.results = self.evaluate()
+        self.position = 0
+        return self
+
+    async def __anext__(self):
+        if self.position >= len(self.results):
+            if self.position == 0:
+                self.collection.database.count_round_trip()
+            raise StopAsyncIteration
+        if self.position % self.batch_count == 0:
+            self.collection.database.count_round_trip()
+        document = self.results[self.position]
+        self.position += 1
+        return document
+
+
+class FakeAggregationCursor(FakeCursor):
+
+    def __init__(self, collection, pipeline):
+        super().__init__(collection, {}, None)
+        self.pipeline = pipeline
+
+    def evaluate(self):
+        documents = [copy.deepcopy(document) for document in self.collection.documents.values()]
+        for stage in self.pipeline:
+            (operator, spec), = stage.items()
+            documents = self.apply_stage(operator, spec, documents)
+        return documents
+
+    def apply_stage(self, operator: str, spec, documents: list[dict]):
+        if operator == "$match":
+            return [document for document in documents if matches(document, spec)]
+        if operator == "$sort":
+            return sort_documents(documents, normalize_sort(spec))
+        if operator == "$limit":
+            return documents[:spec]
+        if operator == "$skip":
+            return documents[spec:]
+        if operator == "$project":
+            return [project(document, spec) for document in documents]
+        if operator == "$addFields":
+            for document in documents:
+                for field, expression in spec.items():
+                    set_path(document, field, self.evaluate_expression(expression, document))
+            return documents
+        if operator == "$group":
+            return self.group(spec, documents)
+        if operator == "$lookup":
+            return [self.lookup(spec, document) for document in documents]
+        raise NotImplementedError(f"Aggregation stage {operator} is not supported")
+
+    def group(self, spec: dict, documents: list[dict]):
+        groups = {}
+        for document in documents:
+            key = self.evaluate_expression(spec["_id"], document)
+            group = groups.setdefault(key, {"_id": key})
+            for field, accumulator in spec.items():
+                if field == "_id":
+                    continue
+                (operator, expression), = accumulator.items()
+                if operator != "$sum":
+                    raise NotImplementedError(f"Accumulator {operator} is not supported")
+                group[field] = group.get(field, 0) + self.evaluate_expression(expression, document)
+        return list(groups.values())
+
+    def lookup(self, spec: dict, document: dict):
+        # the localField/foreignField form, optionally with a pipeline run on the joined documents
+        local_value = get_path(document, spec["localField"])
+        local_values = local_value if isinstance(local_value, list) else [local_value]
+        foreign = self.collection.database[spec["from"]]
+        joined = [copy.deepcopy(foreign_document) for foreign_document in foreign.documents.values()
+                  if any(equals(get_path(foreign_document, spec["foreignField"]), value) for value in local_values)]
+        for stage in spec.get("pipeline", []):
+            (operator, stage_spec), = stage.items()
+            joined = self.apply_stage(operator, stage_spec, joined)
+        document[spec["as"]] = joined
+        return document
+
+    def evaluate_expression(self, expression, document: dict):
+        if expression == {"$meta": "textScore"}:
+            text = next(stage["$match"]["$text"] for stage in self.pipeline
+                        if "$match" in stage and "$text" in stage["$match"])
+            return text_score(document, text["$search"])
+        return evaluate_expression(expression, document)
+
+
+class FakeCollection:
+
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.documents = {}
+        self.unique_indexes = []
+
+    def with_options(self, **kwargs):
+        return self
+
+    def find(self, filter=None, projection=None, **kwargs):
+        return FakeCursor(self, filter or {}, projection)
+
+    def aggregate(self, pipeline, **kwargs):
+        return FakeAggregationCursor(self, pipeline)
+
+    async def find_one(self, filter=None, projection=None, **kwargs):
+        self.database.count_round_trip()
+        document = self.find_first(filter or {})
+        return None if document is None else project(document, projection)
+
+    async def count_documents(self, filter, **kwargs):
+        self.database.count_round_trip()
+        return sum(1 for document in self.documents.values() if matches(document, filter))
+
+    async def insert_one(self, document: dict, **kwargs):
+        self.database.count_round_trip()
+        return InsertOneResult(self.insert(document), acknowledged=True)
+
+    async def insert_many(self, documents: list[dict], ordered: bool = True, **kwargs):
+        self.database.count_round_trip()
+        await self.run_bulk([InsertOne(document) for document in documents], ordered)
+        return InsertManyResult([document["_id"] for document in documents], acknowledged=True)
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, **kwargs):
+        self.database.count_round_trip()
+        return self.update(filter, update, upsert, many=False)
+
+    async def update_many(self, filter: dict, update: dict, upsert: bool = False, **kwargs):
+        self.database.count_round_trip()
+        return self.update(filter, update, upsert, many=True)
+
+    async def find_one_and_update(self, filter: dict, update: dict, projection=None,
+                                  return_document=ReturnDocument.BEFORE, upsert: bool = False, **kwargs):
+        self.database.count_round_trip()
+        document = self.find_first(filter)
+        before = None if document is None else copy.deepcopy(document)
+        self.update(filter, update, upsert, many=False)
+        if return_document == ReturnDocument.AFTER:
+            document = self.find_first(filter if document is None else {"_id": document["_id"]})
+            return None if document is None else project(document, projection)
+        return None if before is None else project(before, projection)
+
+    async def delete_one(self, filter: dict, **kwargs):
+        self.database.count_round_trip()
+        return self.delete(filter, many=False)
+
+    async def delete_many(self, filter: dict, **kwargs):
+        self.database.count_round_trip()
+        return self.delete(filter, many=True)
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs):
+        self.database.count_round_trip()
+        return await self.run_bulk(requests, ordered)
+
+    async def create_indexes(self, indexes: list, **kwargs):
+        self.database.count_round_trip()
+        for index in indexes:
+            document = index.document
+            if document.get("unique"):
+                keys = [key for key in document["key"]]
+                if keys not in self.unique_indexes:
+                    self.unique_indexes.append(keys)
+        return [index.document["name"] for index in indexes]
+
+    async def drop(self, **kwargs):
+        self.database.count_round_trip()
+        self.documents.clear()
+        self.unique_indexes.clear()
+
+    def find_first(self, filter: dict):
+        if set(filter) == {"_id"} and not isinstance(filter["_id"], dict):
+            return self.documents.get(filter["_id"])
+        return next((document for document in self.documents.values() if matches(document, filter)), None)
+
+    def check_unique(self, document: dict):
+        for keys in self.unique_indexes:
+            values = [get_path(document, key) for key in keys]
+            for other in self.documents.values():
+                if other["_id"] != document["_id"] and [get_path(other, key) for key in keys] == values:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name}",
+                                            DUPLICATE_KEY_ERROR)
+
+    def insert(self, document: dict):
+        if "_id" not in document:
+            raise ValueError("Documents inserted into the fake database need an _id")
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_",
+                                    DUPLICATE_KEY_ERROR)
+        self.check_unique(document)
+        self.documents[document["_id"]] = copy.deepcopy(document)
+        return document["_id"]
+
+    def update(self, filter: dict, update: dict, upsert: bool, many: bool):
+        documents = [document for document in self.documents.values() if matches(document, filter)]
+        if not many:
+            documents = documents[:1]
+        for document in documents:
+            updated = copy.deepcopy(document)
+            apply_update(updated, update)
+            self.check_unique(updated)
+            self.documents[document["_id"]] = updated
+        if documents or not upsert:
+            return UpdateResult({"n": len(documents), "nModified": len(documents)}, acknowledged=True)
+        document = {key: value for key, value in filter.items() if not key.startswith("$")
+                    and not isinstance(value, dict)}
+        apply_update(document, update, inserting=True)
+        document.setdefault("_id", str(len(self.documents)))
+        self.insert(document)
+        return UpdateResult({"n": 1, "nModified": 0, "upserted": document["_id"]}, acknowledged=True)
+
+    def delete(self, filter: dict, many: bool):
+        documents = [document for document in self.documents.values() if matches(document, filter)]
+        if not many:
+            documents = documents[:1]
+        for document in documents:
+            del self.documents[document["_id"]]
+        return DeleteResult({"n": len(documents)}, acknowledged=True)
+
+    async def run_bulk(self, requests: list, ordered: bool):
+        counts = defaultdict(int)
+        errors = []
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self.insert(request._doc)
+                    counts["nInserted"] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    result = self.update(request._filter, request._doc, request._upsert,
+                                         many=isinstance(request, UpdateMany))
+                    counts["nMatched"] += result.matched_count
+                    counts["nModified"] += result.modified_count
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    result = self.delete(request._filter, many=isinstance(request, DeleteMany))
+                    counts["nRemoved"] += result.deleted_count
+                else:
+                    raise NotImplementedError(f"Bulk operation {type(request).__name__} is not supported")
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": DUPLICATE_KEY_ERROR, "errmsg": str(e), "op": request})
+                if ordered:
+                    break
+        details = {"writeErrors": errors, "writeConcernErrors": [], "upserted": [], **counts}
+        if errors:
+            raise BulkWriteError(details)
+        return BulkWriteResult(details, acknowledged=True)
+
+
+class FakeDatabase:
+
+    def __init__(self, name: str = "fake"):
+        self.name = name
+        self.collections = {}
+        self.round_trips = 0
+
+    def count_round_trip(self):
+        self.round_trips += 1
+
+    def __getitem__(self, name: str):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
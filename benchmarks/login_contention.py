@@ -0,0 +1,94 @@
+"""Latency of /wall while other clients keep logging in.
+
+Runs the application in-process against the database configured by
+CUSTOMCONNSTR_MONGODB, once with bcrypt executed directly on the event loop
+(the behaviour before password hashing moved to a worker pool) and once with the
+worker pool, and prints the /wall latency percentiles of both runs.
+
+    python -m benchmarks.login_contention --login-concurrency 8 --requests 200
+
+/wall is requested at a fixed interval and latency is measured from the time a
+request was due, so stalls of the event loop are not hidden by the client
+waiting for them too.
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import Executor, Future
+
+import httpx
+
+import api
+import crud
+import passwords
+import schemas
+from database import db
+
+
+USERNAME = "benchmark.login@example.com"
+PASSWORD = "benchmark"
+
+
+class InlineExecutor(Executor):
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+def percentile(values: list[float], q: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+
+async def ensure_user():
+    if await crud.get_user(db, USERNAME) is None:
+        await crud.create_user(db, schemas.UserCreate(username=USERNAME, password=PASSWORD, is_teacher=False))
+
+
+async def measure_wall(login_concurrency: int, requests: int, interval: float):
+    credentials = {"username": USERNAME, "password": PASSWORD}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://benchmark") as client:
+        response = await client.post("/token", data=credentials)
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        stop = asyncio.Event()
+
+        async def log_in_repeatedly():
+            while not stop.is_set():
+                await client.post("/token", data=credentials)
+
+        logins = [asyncio.create_task(log_in_repeatedly()) for _ in range(login_concurrency)]
+        latencies = []
+        due = time.perf_counter()
+        for _ in range(requests):
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            await client.get("/wall", headers=headers)
+            latencies.append((time.perf_counter() - due) * 1000)
+            due += interval
+        stop.set()
+        await asyncio.gather(*logins)
+    return latencies
+
+
+async def main(args):
+    await ensure_user()
+    pool_executor = passwords.executor
+    print(f"{'hashing':<12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, executor in (("event loop", InlineExecutor()), ("worker pool", pool_executor)):
+        passwords.executor = executor
+        latencies = await measure_wall(args.login_concurrency, args.requests, args.interval_ms / 1000)
+        print(f"{name:<12}{percentile(latencies, 0.5):>10.1f}{percentile(latencies, 0.99):>10.1f}"
+              f"{max(latencies):>10.1f}")
+    passwords.executor = pool_executor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--login-concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,60 @@
+"""Time spent turning one wall page into a response body.
+
+Compares the generic FastAPI path (validation against the response model,
+`jsonable_encoder` and `json.dumps`), the same path rendered with orjson, and the
+direct encoding of the Mongo documents used by the wall and comment routes.
+
+    python -m benchmarks.serialization --posts 1000
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import schemas
+import serialization
+
+
+def make_posts(count: int):
+    return [{"_id": f"{1672531200 + i:08x}{i:016x}", "text": f"Post number {i} " * 8,
+             "author_id": f"{1672531200:08x}{i % 50:016x}", "course_id": f"{1672531200:08x}{i % 7:016x}",
+             "class_id": None, "like_count": i % 13, "comment_count": i % 5} for i in range(count)]
+
+
+async def generic(field, posts, response_class):
+    content = await serialize_response(field=field, response_content=posts, is_coroutine=True)
+    return response_class(content).body
+
+
+async def direct(field, posts, response_class):
+    return serialization.documents_response(posts).body
+
+
+async def measure(encode, field, posts, response_class, iterations: int):
+    await encode(field, posts, response_class)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await encode(field, posts, response_class)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+async def main(args):
+    field = create_response_field(name="Response", type_=list[schemas.Post])
+    posts = make_posts(args.posts)
+    print(f"{'path':<40}{'ms per wall':>12}")
+    for name, encode, response_class in (
+            ("response model + jsonable_encoder", generic, JSONResponse),
+            ("response model + orjson", generic, serialization.ORJSONResponse),
+            ("direct orjson", direct, serialization.ORJSONResponse)):
+        milliseconds = await measure(encode, field, posts, response_class, args.iterations)
+        print(f"{name:<40}{milliseconds:>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--posts", type=int, default=1000, help="posts on the wall")
+    parser.add_argument("--iterations", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,81 @@
+import os
+import time
+from collections import OrderedDict
+
+from schemas import UserPermissions
+
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+# e.g. redis://localhost:6379/0; shares the cache between uvicorn workers, requires the `redis` package
+USER_CACHE_REDIS_URL = os.getenv("USER_CACHE_REDIS_URL")
+
+
+class MemoryCache:
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key: str, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def delete(self, key: str):
+        self.entries.pop(key, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+class RedisCache:
+    """Stores pydantic models as JSON, so a worker only ever reads data back, never code."""
+
+    def __init__(self, url: str, ttl: float, prefix: str, model):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str):
+        value = await self.redis.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.model.parse_raw(value)
+
+    async def set(self, key: str, value):
+        await self.redis.set(self.prefix + key, value.json(), px=int(self.ttl * 1000))
+
+    async def delete(self, key: str):
+        await self.redis.delete(self.prefix + key)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+if USER_CACHE_REDIS_URL:
+    user_cache = RedisCache(USER_CACHE_REDIS_URL, USER_CACHE_TTL_SECONDS, prefix="user:", model=UserPermissions)
+else:
+    user_cache = MemoryCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
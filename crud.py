@@ -1,221 +1,681 @@
+import events
+import likes
+import os
 import schemas
+import snippets
+from cache import user_cache
+from collections import Counter, defaultdict
+from typing import Union
 from fastapi.encoders import jsonable_encoder
-from passlib.context import CryptContext
+from passwords import hash_password
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+EXPORT_BATCH_SIZE = 200
 
+# materialized home timelines for /wall, see get_timeline_wall
+WALL_TIMELINES = os.getenv("WALL_TIMELINES", "").lower() in ("1", "true", "yes")
+TIMELINE_LENGTH = int(os.getenv("TIMELINE_LENGTH", "500"))
+TIMELINE_FANOUT_THRESHOLD = int(os.getenv("TIMELINE_FANOUT_THRESHOLD", "1000"))
 
-async def get_user(db, username: str):
-    user = await db["users"].find_one({"username": username})
+# version IDs of the course and class catalogs; the walls use the course or class ID
+CATALOG_COURSES = "courses"
+CATALOG_CLASSES = "classes"
+
+LIKE_POST = "post"
+LIKE_COMMENT = "comment"
+DUPLICATE_KEY_ERROR = 11000
+
+SEARCH_POST = "post"
+SEARCH_COMMENT = "comment"
+
+
+class TargetDeleted(Exception):
+    """The post or comment was deleted after the access check, while it was being liked or unliked."""
+
+
+def projection(model):
+    return {field.alias: 1 for field in model.__fields__.values()}
+
+
+def get_scope_id(post):
+    return post.course_id or post.class_id
+
+
+def get_collection(db, name: str, write_concern: Union[WriteConcern, None] = None):
+    if write_concern is None:
+        return db[name]
+    return db[name].with_options(write_concern=write_concern)
+
+
+async def get_versions(db, ids: list[str]):
+    if not ids:
+        return []
+    documents = await db['versions'].find({'_id': {'$in': ids}}).to_list(len(ids))
+    versions = {document['_id']: document['version'] for document in documents}
+    return [versions.get(id, 0) for id in ids]
+
+
+async def bump_versions(db, ids: list[str]):
+    """Advance the versions ETags are computed from; call it after the write it announces."""
+    ids = {id for id in ids if id}
+    if ids:
+        await db['versions'].bulk_write([UpdateOne({'_id': id}, {'$inc': {'version': 1}}, upsert=True)
+                                         for id in ids], ordered=False)
+
+
+async def get_user(db, username: str, model=schemas.User):
+    user = await db["users"].find_one({"username": username}, projection(model))
     if user is None:
         return None
-    return schemas.User(**user)
+    return model(**user)
 
 
-async def create_user(db, user: schemas.UserCreate):
-    hashed_password = pwd_context.hash(user.password)
+async def create_user(db, user: schemas.UserCreate, write_concern: Union[WriteConcern, None] = None):
+    hashed_password = await hash_password(user.password)
     db_user = schemas.User(username=user.username, hashed_password=hashed_password, is_teacher=user.is_teacher)
-    db_user = jsonable_encoder(db_user)
-    new_user = await db['users'].insert_one(db_user)
-    created_user = await db['users'].find_one({"_id": new_user.inserted_id})
-    return schemas.User(**created_user)
+    await get_collection(db, 'users', write_concern).insert_one(jsonable_encoder(db_user))
+    return db_user
 
 
-async def get_class(db, id: str):
-    a_class = await db['classes'].find_one({"_id": id})
+async def get_class(db, id: str, model=schemas.Class):
+    a_class = await db['classes'].find_one({"_id": id}, projection(model))
     if a_class is None:
         return None
-    return schemas.Class(**a_class)
+    return model(**a_class)
 
 
-async def create_class(db, a_class: schemas.ClassCreate):
+async def create_class(db, a_class: schemas.ClassCreate, write_concern: Union[WriteConcern, None] = None):
     db_class = schemas.Class(name=a_class.name)
-    db_class = jsonable_encoder(db_class)
-    new_class = await db['classes'].insert_one(db_class)
-    created_class = await db['classes'].find_one({"_id": new_class.inserted_id})
-    return schemas.Class(**created_class)
+    await get_collection(db, 'classes', write_concern).insert_one(jsonable_encoder(db_class))
+    await bump_versions(db, [CATALOG_CLASSES])
+    return db_class
 
 
-async def get_course(db, id: str):
-    course = await db['courses'].find_one({"_id": id})
+async def get_course(db, id: str, model=schemas.Course):
+    course = await db['courses'].find_one({"_id": id}, projection(model))
     if course is None:
         return None
-    return schemas.Course(**course)
+    return model(**course)
 
 
 async def get_courses(db):
-    courses = await db['courses'].find({}).to_list(1000)
-    result = []
-    for course in courses:
-        result.append(schemas.Course(**course))
-    return result
+    return await db['courses'].find({}, projection(schemas.Course)).to_list(1000)
 
 
 async def get_classes(db):
-    classes = await db['classes'].find({}).to_list(1000)
-    result = []
-    for a_class in classes:
-        result.append(schemas.Course(**a_class))
-    return result
+    return await db['classes'].find({}, projection(schemas.Class)).to_list(1000)
 
 
-async def create_course(db, course: schemas.CourseCreate):
-    db_course = schemas.Class(name=course.name)
-    db_course = jsonable_encoder(db_course)
-    new_course = await db['courses'].insert_one(db_course)
-    created_course = await db['courses'].find_one({"_id": new_course.inserted_id})
-    return schemas.Course(**created_course)
+async def create_course(db, course: schemas.CourseCreate, write_concern: Union[WriteConcern, None] = None):
+    db_course = schemas.Course(name=course.name)
+    await get_collection(db, 'courses', write_concern).insert_one(jsonable_encoder(db_course))
+    await bump_versions(db, [CATALOG_COURSES])
+    return db_course
 
 
 async def associate_user_course(db, user: schemas.User, course: schemas.Course):
-    new_user = user
-    new_user.course_ids.append(str(course.id))
-    update_result = await db['users'].update_one({"_id": str(user.id)}, {"$set": {"course_ids": new_user.course_ids}})
-    updated_user = await db['users'].find_one({"_id": str(user.id)})
-
-    new_course = course
-    new_course.user_ids.append(str(updated_user['_id']))
-    update_result = await db['courses'].update_one({"_id": str(course.id)}, {"$set": {"user_ids": new_course.user_ids}})
-    updated_course = await db['courses'].find_one({"_id": str(course.id)})
+    updated_user = await db['users'].find_one_and_update({"_id": str(user.id)},
+                                                         {"$addToSet": {"course_ids": str(course.id)}},
+                                                         return_document=ReturnDocument.AFTER)
+    updated_course = await db['courses'].find_one_and_update({"_id": str(course.id)},
+                                                             {"$addToSet": {"user_ids": str(user.id)}},
+                                                             return_document=ReturnDocument.AFTER)
+    await user_cache.delete(user.username)
+    await invalidate_timelines(db, [str(user.id)])
+    await bump_versions(db, [CATALOG_COURSES])
 
     return schemas.User(**updated_user), schemas.Course(**updated_course)
 
 
 async def associate_user_class(db, user: schemas.User, a_class: schemas.Class):
-    new_user = user
-    new_user.class_ids.append(str(a_class.id))
-    update_result = await db['users'].update_one({"_id": str(user.id)}, {"$set": {"class_ids": new_user.class_ids}})
-    updated_user = await db['users'].find_one({"_id": str(user.id)})
-
-    new_class = a_class
-    new_class.user_ids.append(str(updated_user['_id']))
-    new_class = await db['classes'].update_one({"_id": str(a_class.id)}, {"$set": {"user_ids": new_class.user_ids}})
-    updated_class = await db['classes'].find_one({"_id": str(a_class.id)})
+    updated_user = await db['users'].find_one_and_update({"_id": str(user.id)},
+                                                         {"$addToSet": {"class_ids": str(a_class.id)}},
+                                                         return_document=ReturnDocument.AFTER)
+    updated_class = await db['classes'].find_one_and_update({"_id": str(a_class.id)},
+                                                            {"$addToSet": {"user_ids": str(user.id)}},
+                                                            return_document=ReturnDocument.AFTER)
+    await user_cache.delete(user.username)
+    await invalidate_timelines(db, [str(user.id)])
+    await bump_versions(db, [CATALOG_CLASSES])
 
     return schemas.User(**updated_user), schemas.Class(**updated_class)
 
 
-async def create_post_in_course(db, text: str, user: schemas.User, course: schemas.Course):
+async def create_post_in_course(db, text: str, user: schemas.User, course: schemas.Course,
+                                write_concern: Union[WriteConcern, None] = None):
     db_post = schemas.Post(text=text, author_id=str(user.id), course_id=str(course.id))
-    db_post = jsonable_encoder(db_post)
-    new_post = await db['posts'].insert_one(db_post)
-    created_post = await db['posts'].find_one({'_id': new_post.inserted_id})
-    return schemas.Post(**created_post)
+    await get_collection(db, 'posts', write_concern).insert_one(jsonable_encoder(db_post))
+    await fan_out_posts(db, str(course.id), [str(db_post.id)])
+    await bump_versions(db, [str(course.id)])
+    await events.broker.publish(str(course.id), events.POST_CREATED, db_post)
+    return db_post
 
 
-async def create_post_in_class(db, text: str, user: schemas.User, a_class: schemas.Class):
+async def create_post_in_class(db, text: str, user: schemas.User, a_class: schemas.Class,
+                               write_concern: Union[WriteConcern, None] = None):
     db_post = schemas.Post(text=text, author_id=str(user.id), class_id=str(a_class.id))
-    db_post = jsonable_encoder(db_post)
-    new_post = await db['posts'].insert_one(db_post)
-    created_post = await db['posts'].find_one({'_id': new_post.inserted_id})
-    return schemas.Post(**created_post)
-
-
-async def get_posts_for_course(db, course_id):
-    posts = await db['posts'].find({'course_id': course_id}).to_list(1000)
-    return posts
-
-
-async def get_posts_for_class(db, class_id):
-    posts = await db['posts'].find({'class_id': class_id}).to_list(1000)
+    await get_collection(db, 'posts', write_concern).insert_one(jsonable_encoder(db_post))
+    await fan_out_posts(db, str(a_class.id), [str(db_post.id)])
+    await bump_versions(db, [str(a_class.id)])
+    await events.broker.publish(str(a_class.id), events.POST_CREATED, db_post)
+    return db_post
+
+
+async def create_posts(db, posts: list[schemas.Post], write_concern: Union[WriteConcern, None] = None):
+    if posts:
+        await get_collection(db, 'posts', write_concern).insert_many([jsonable_encoder(post) for post in posts])
+        post_ids_by_scope = defaultdict(list)
+        for post in posts:
+            post_ids_by_scope[get_scope_id(post)].append(str(post.id))
+        for scope_id, post_ids in post_ids_by_scope.items():
+            await fan_out_posts(db, scope_id, post_ids)
+        await bump_versions(db, list(post_ids_by_scope))
+        for post in posts:
+            await events.broker.publish(get_scope_id(post), events.POST_CREATED, post)
     return posts
 
 
-async def get_post(db, id: str):
-    post = await db['posts'].find_one({"_id": id})
+async def get_page(collection, query: dict, limit: int = DEFAULT_PAGE_SIZE,
+                   after: Union[str, None] = None, descending: bool = True, model=None):
+    """Return one page of documents ordered by `_id` and the cursor of the next page.
+
+    Stored `_id`s are ObjectId hex strings, so their order follows creation time and
+    `after` can be applied as a range condition instead of skipping documents.
+    """
+    if after is not None:
+        query = {**query, '_id': {'$lt' if descending else '$gt': after}}
+    cursor = collection.find(query, projection(model) if model else None).sort('_id', -1 if descending else 1)
+    items = await cursor.to_list(limit + 1)
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = items[-1]['_id']
+    return items, next_cursor
+
+
+async def get_posts_for_course(db, course_id: str, limit: int = DEFAULT_PAGE_SIZE, after: Union[str, None] = None):
+    return await get_page(db['posts'], {'course_id': course_id}, limit, after, model=schemas.Post)
+
+
+async def get_posts_for_class(db, class_id: str, limit: int = DEFAULT_PAGE_SIZE, after: Union[str, None] = None):
+    return await get_page(db['posts'], {'class_id': class_id}, limit, after, model=schemas.Post)
+
+
+async def get_wall(db, user: schemas.User, limit: int = DEFAULT_PAGE_SIZE, after: Union[str, None] = None):
+    scopes = []
+    if user.class_ids:
+        scopes.append({'class_id': {'$in': user.class_ids}})
+    if user.course_ids:
+        scopes.append({'course_id': {'$in': user.course_ids}})
+    if not scopes:
+        return [], None
+    return await get_page(db['posts'], {'$or': scopes}, limit, after, model=schemas.Post)
+
+
+async def fan_out_posts(db, scope_id: str, post_ids: list[str]):
+    if WALL_TIMELINES:
+        await db['timelines'].update_many({'fan_out_scope_ids': scope_id},
+                                          {'$push': {'post_ids': {'$each': post_ids, '$sort': -1,
+                                                                  '$slice': TIMELINE_LENGTH}}})
+
+
+async def remove_from_timelines(db, scope_id: str, post_id: str):
+    query = {'fan_out_scope_ids': scope_id, 'post_ids': post_id}
+    await db['timelines'].update_many({**query, f'post_ids.{TIMELINE_LENGTH - 1}': {'$exists': False}},
+                                      {'$pull': {'post_ids': post_id}})
+    # a full timeline has dropped older posts, which its length no longer shows once it is shorter,
+    # so it keeps its last ID as covers_from; timelines filled by a push meanwhile are caught here too
+    await db['timelines'].update_many(query, [{'$set': {
+        'covers_from': {'$max': ['$covers_from', {'$arrayElemAt': ['$post_ids', -1]}]},
+        'post_ids': {'$filter': {'input': '$post_ids', 'cond': {'$ne': ['$$this', post_id]}}},
+    }}])
+
+
+async def invalidate_timelines(db, user_ids: list[str]):
+    # the timelines are rebuilt by the next read of the wall
+    if WALL_TIMELINES and user_ids:
+        await db['timelines'].delete_many({'_id': {'$in': user_ids}})
+
+
+async def build_timeline(db, user: schemas.User):
+    scopes = await db['courses'].find({'_id': {'$in': user.course_ids}}, {'user_ids': 1}).to_list(None) + \
+        await db['classes'].find({'_id': {'$in': user.class_ids}}, {'user_ids': 1}).to_list(None)
+    timeline = schemas.Timeline(id=str(user.id))
+    for scope in scopes:
+        if len(scope['user_ids']) > TIMELINE_FANOUT_THRESHOLD:
+            timeline.read_scope_ids.append(scope['_id'])
+        else:
+            timeline.fan_out_scope_ids.append(scope['_id'])
+
+    # the document exists before the posts are read, so posts created meanwhile are pushed to it
+    # and merged with the backfill below
+    document = jsonable_encoder(timeline)
+    await db['timelines'].update_one({'_id': timeline.id}, {'$setOnInsert': document}, upsert=True)
+    if not timeline.fan_out_scope_ids:
+        return document
+
+    posts = await db['posts'].find({'$or': [{'class_id': {'$in': timeline.fan_out_scope_ids}},
+                                            {'course_id': {'$in': timeline.fan_out_scope_ids}}]},
+                                   {'_id': 1}).sort('_id', -1).to_list(TIMELINE_LENGTH)
+    update = {'$push': {'post_ids': {'$each': [post['_id'] for post in posts], '$sort': -1,
+                                     '$slice': TIMELINE_LENGTH}}}
+    if len(posts) == TIMELINE_LENGTH:
+        update['$max'] = {'covers_from': posts[-1]['_id']}
+    # a timeline invalidated during the build is gone and is not written again
+    stored = await db['timelines'].find_one_and_update({'_id': timeline.id}, update,
+                                                       return_document=ReturnDocument.AFTER)
+    if stored is None:
+        document['post_ids'] = [post['_id'] for post in posts]
+        document['covers_from'] = posts[-1]['_id'] if len(posts) == TIMELINE_LENGTH else None
+        return document
+    return stored
+
+
+async def get_timeline_wall(db, user: schemas.User, limit: int = DEFAULT_PAGE_SIZE, after: Union[str, None] = None):
+    """Read the wall from the user's materialized timeline.
+
+    New posts are pushed to the timelines of the members of small courses and classes
+    when they are written. Posts of courses and classes with more than
+    `TIMELINE_FANOUT_THRESHOLD` members are not, and are queried at read time instead.
+    Timelines keep the newest `TIMELINE_LENGTH` posts; pages reaching past
+    `covers_from` fall back to `get_wall`.
+    """
+    timeline = await db['timelines'].find_one({'_id': str(user.id)})
+    if timeline is None:
+        timeline = await build_timeline(db, user)
+
+    # pushes drop the oldest IDs, so a full timeline covers the posts from its last one on
+    covers_from = timeline['covers_from']
+    if len(timeline['post_ids']) >= TIMELINE_LENGTH:
+        covers_from = max(covers_from or '', timeline['post_ids'][-1])
+    # a post pushed while the timeline was built can be in it twice
+    post_ids = [id for id in dict.fromkeys(timeline['post_ids']) if after is None or id < after][:limit + 1]
+    scopes = [{'_id': {'$in': post_ids}}]
+    if timeline['read_scope_ids']:
+        scopes.append({'class_id': {'$in': timeline['read_scope_ids']}})
+        scopes.append({'course_id': {'$in': timeline['read_scope_ids']}})
+    posts, next_cursor = await get_page(db['posts'], {'$or': scopes}, limit, after, model=schemas.Post)
+
+    if covers_from is not None and (next_cursor is None or next_cursor < covers_from):
+        return await get_wall(db, user, limit, after)
+    return posts, next_cursor
+
+
+def search_cursor(result: dict):
+    return f"{result['score']!r}:{result['_id']}"
+
+
+def parse_search_cursor(cursor: str):
+    score, _, id = cursor.partition(':')
+    if not id:
+        raise ValueError("Invalid search cursor")
+    return float(score), id
+
+
+async def search_collection(collection, query: dict, search: str, limit: int, after: Union[tuple, None],
+                            fields: dict):
+    pipeline = [{'$match': {'$text': {'$search': search}, **query}},
+                {'$addFields': {'score': {'$meta': 'textScore'}}}]
+    if after is not None:
+        score, id = after
+        pipeline.append({'$match': {'$or': [{'score': {'$lt': score}}, {'score': score, '_id': {'$lt': id}}]}})
+    pipeline += [{'$sort': {'score': -1, '_id': -1}},
+                 {'$limit': limit + 1},
+                 {'$project': {**fields, 'text': 1, 'author_id': 1, 'score': 1}}]
+    return await collection.aggregate(pipeline).to_list(limit + 1)
+
+
+async def search_posts_and_comments(db, user: schemas.User, search: str, limit: int = DEFAULT_PAGE_SIZE,
+                                    after: Union[tuple, None] = None):
+    """Return one page of the posts and comments in the user's courses and classes matching `search`.
+
+    Results are ordered by relevance and then by `_id`, and `after` is the `(score, _id)`
+    of the last result of the previous page. Membership is part of the text query and
+    each collection returns at most `limit + 1` documents, so a page costs the same
+    however many posts and comments there are.
+    """
+    scope_ids = user.course_ids + user.class_ids
+    if not scope_ids:
+        return [], None
+    posts = await search_collection(db['posts'], {'$or': [{'class_id': {'$in': user.class_ids}},
+                                                          {'course_id': {'$in': user.course_ids}}]},
+                                    search, limit, after, {'course_id': 1, 'class_id': 1})
+    comments = await search_collection(db['comments'], {'scope_id': {'$in': scope_ids}},
+                                       search, limit, after, {'post_id': 1, 'scope_id': 1})
+    for post in posts:
+        scope_id = post.pop('course_id', None) or post.pop('class_id', None)
+        post.update(type=SEARCH_POST, post_id=post['_id'], scope_id=scope_id)
+        post.pop('class_id', None)
+    for comment in comments:
+        comment['type'] = SEARCH_COMMENT
+
+    results = sorted(posts + comments, key=lambda result: (result['score'], result['_id']), reverse=True)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = search_cursor(results[-1])
+    terms = snippets.search_terms(search)
+    for result in results:
+        result['snippet'] = snippets.make_snippet(result.pop('text'), terms)
+    return results, next_cursor
+
+
+async def get_posts_by_ids(db, ids: list[str], model=schemas.Post):
+    posts = await db['posts'].find({"_id": {"$in": ids}}, projection(model)).to_list(len(ids))
+    return [model(**post) for post in posts]
+
+
+async def get_post(db, id: str, model=schemas.Post):
+    post = await db['posts'].find_one({"_id": id}, projection(model))
     if post is None:
         return None
-    return schemas.Post(**post)
+    return model(**post)
 
 
 async def remove_post(db, post: schemas.Post):
     result = await db['posts'].delete_one({'_id': str(post.id)})
+    if result.deleted_count:
+        likes.buffer.discard_target(LIKE_POST, str(post.id))
+        await db['likes'].delete_many({'target_type': LIKE_POST, 'target_id': str(post.id)})
+        # the comments stay, but without a scope search no longer finds them
+        await db['comments'].update_many({'post_id': str(post.id)}, {'$unset': {'scope_id': ''}})
+        if WALL_TIMELINES:
+            await remove_from_timelines(db, get_scope_id(post), str(post.id))
+        await bump_versions(db, [get_scope_id(post)])
+        await events.broker.publish(get_scope_id(post), events.POST_DELETED, {'_id': str(post.id)})
     return result
 
 
-async def like_post(db, post: schemas.Post, user: schemas.User):
-    user.likes_post_ids.append(str(post.id))
-    update_result = await db['users'].update_one({'_id': str(user.id)},
-                                                 {"$set": {"likes_post_ids": user.likes_post_ids}})
-    updated_user = await db['users'].find_one({"_id": str(user.id)})
+async def add_like(db, user: schemas.User, target_type: str, target_id: str):
+    like = schemas.Like(user_id=str(user.id), target_type=target_type, target_id=target_id)
+    try:
+        await db['likes'].insert_one(jsonable_encoder(like))
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def update_like_count(db, user: schemas.User, collection: str, target_type: str, target_id: str, change: int):
+    document = await db[collection].find_one_and_update({'_id': target_id}, {"$inc": {"like_count": change}},
+                                                        return_document=ReturnDocument.AFTER)
+    if document is None:
+        # the target's likes were deleted with it, apart from the one just inserted
+        if change > 0:
+            await delete_like(db, user, target_type, target_id)
+        raise TargetDeleted(target_type, target_id)
+    return document
+
+
+async def delete_like(db, user: schemas.User, target_type: str, target_id: str):
+    result = await db['likes'].delete_one({'user_id': str(user.id), 'target_type': target_type,
+                                           'target_id': target_id})
+    return result.deleted_count == 1
+
+
+async def get_liked_ids(db, user: schemas.User, target_type: str, target_ids: list[str]):
+    user_likes = await db['likes'].find({'user_id': str(user.id), 'target_type': target_type,
+                                         'target_id': {'$in': target_ids}},
+                                        {'_id': 0, 'target_id': 1}).to_list(len(target_ids))
+    liked_ids = [like['target_id'] for like in user_likes]
+    if likes.LIKE_WRITE_BEHIND:
+        liked_ids = set(liked_ids)
+        for target_id in target_ids:
+            liked = likes.buffer.get((str(user.id), target_type, target_id))
+            if liked is not None:
+                (liked_ids.add if liked else liked_ids.discard)(target_id)
+        liked_ids = [target_id for target_id in dict.fromkeys(target_ids) if target_id in liked_ids]
+    return liked_ids
+
+
+async def buffer_like(db, user: schemas.User, target_type: str, target_id: str, liked: bool):
+    """Record a like or an unlike in `likes.buffer`; False when the target already is in that state."""
+    pair = (str(user.id), target_type, target_id)
+    current = likes.buffer.get(pair)
+    if current is None:
+        current = await db['likes'].find_one({'user_id': pair[0], 'target_type': target_type,
+                                              'target_id': target_id}, {'_id': 1}) is not None
+    return current != liked and likes.buffer.record(pair, liked)
+
+
+async def get_buffered(db, collection: str, target_type: str, id: str, model):
+    document = await db[collection].find_one({'_id': id}, projection(model))
+    if document is None:
+        # deleted after the access check; the change just recorded must not be written
+        likes.buffer.discard_target(target_type, id)
+        raise TargetDeleted(target_type, id)
+    document['like_count'] += likes.buffer.delta(target_type, id)
+    return document
+
+
+async def write_buffered_likes(db, changes: dict):
+    """Write a batch of `likes.buffer`, then recount the likes of the posts and comments it touched.
+
+    Recounting instead of incrementing keeps the counters right when another process
+    wrote the same like in the meantime.
+    """
+    requests = []
+    target_ids = {LIKE_POST: set(), LIKE_COMMENT: set()}
+    for (user_id, target_type, target_id), liked in changes.items():
+        like = {'user_id': user_id, 'target_type': target_type, 'target_id': target_id}
+        if liked:
+            requests.append(InsertOne(jsonable_encoder(schemas.Like(**like))))
+        else:
+            requests.append(DeleteOne(like))
+        target_ids[target_type].add(target_id)
+    try:
+        await db['likes'].bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+
+    counts = await db['likes'].aggregate([
+        {'$match': {'$or': [{'target_type': target_type, 'target_id': {'$in': list(ids)}}
+                            for target_type, ids in target_ids.items() if ids]}},
+        {'$group': {'_id': '$target_id', 'count': {'$sum': 1}}},
+    ]).to_list(None)
+    counts = {group['_id']: group['count'] for group in counts}
+    for target_type, collection in ((LIKE_POST, 'posts'), (LIKE_COMMENT, 'comments')):
+        if target_ids[target_type]:
+            await db[collection].bulk_write([UpdateOne({'_id': id}, {'$set': {'like_count': counts.get(id, 0)}})
+                                             for id in target_ids[target_type]], ordered=False)
+
+    # the likes of a post or comment deleted before they were written are not deleted with it;
+    # one deleted after this read has its likes deleted by remove_post or remove_comment
+    deleted = []
+    if target_ids[LIKE_POST]:
+        posts = await db['posts'].find({'_id': {'$in': list(target_ids[LIKE_POST])}},
+                                       projection(schemas.Post)).to_list(None)
+        deleted += [(LIKE_POST, id) for id in target_ids[LIKE_POST] - {post['_id'] for post in posts}]
+        await bump_versions(db, [get_scope_id(schemas.PostAccess(**post)) for post in posts])
+        for post in posts:
+            await events.broker.publish(get_scope_id(schemas.PostAccess(**post)), events.POST_UPDATED, post)
+    if target_ids[LIKE_COMMENT]:
+        comments = await db['comments'].find({'_id': {'$in': list(target_ids[LIKE_COMMENT])}},
+                                             {**projection(schemas.Comment), 'scope_id': 1}).to_list(None)
+        deleted += [(LIKE_COMMENT, id) for id in target_ids[LIKE_COMMENT] - {comment['_id'] for comment in comments}]
+        for comment in comments:
+            scope_id = comment.pop('scope_id', None)
+            if scope_id is not None:
+                await events.broker.publish(scope_id, events.COMMENT_UPDATED, comment)
+    if deleted:
+        await db['likes'].delete_many({'$or': [{'target_type': target_type, 'target_id': id}
+                                               for target_type, id in deleted]})
 
-    post.likes_user_ids.append(str(user.id))
-    update_result = await db['posts'].update_one({'_id': str(post.id)},
-                                                 {"$set": {"likes_user_ids": post.likes_user_ids}})
-    updated_post = await db['posts'].find_one({"_id": str(post.id)})
 
-    return updated_user, updated_post
+async def like_post(db, post: schemas.Post, user: schemas.User):
+    if likes.LIKE_WRITE_BEHIND:
+        if not await buffer_like(db, user, LIKE_POST, str(post.id), True):
+            return None
+        return await get_buffered(db, 'posts', LIKE_POST, str(post.id), schemas.Post)
+    if not await add_like(db, user, LIKE_POST, str(post.id)):
+        return None
+    updated_post = await update_like_count(db, user, 'posts', LIKE_POST, str(post.id), 1)
+    await bump_versions(db, [get_scope_id(post)])
+    await events.broker.publish(get_scope_id(post), events.POST_UPDATED, updated_post)
+    return updated_post
 
 
 async def remove_like_from_post(db, post: schemas.Post, user: schemas.User):
-    user.likes_post_ids.remove(str(post.id))
-    update_result = await db['users'].update_one({'_id': str(user.id)},
-                                                 {"$set": {"likes_post_ids": user.likes_post_ids}})
-    updated_user = await db['users'].find_one({"_id": str(user.id)})
-
-    post.likes_user_ids.remove(str(user.id))
-    update_result = await db['posts'].update_one({'_id': str(post.id)},
-                                                 {"$set": {"likes_user_ids": post.likes_user_ids}})
-    updated_post = await db['posts'].find_one({"_id": str(post.id)})
-
-    return updated_user, updated_post
+    if likes.LIKE_WRITE_BEHIND:
+        if not await buffer_like(db, user, LIKE_POST, str(post.id), False):
+            return None
+        return await get_buffered(db, 'posts', LIKE_POST, str(post.id), schemas.Post)
+    if not await delete_like(db, user, LIKE_POST, str(post.id)):
+        return None
+    updated_post = await update_like_count(db, user, 'posts', LIKE_POST, str(post.id), -1)
+    await bump_versions(db, [get_scope_id(post)])
+    await events.broker.publish(get_scope_id(post), events.POST_UPDATED, updated_post)
+    return updated_post
 
 
-async def create_comment(db, text: str, post: schemas.Post, user: schemas.User):
+async def create_comment(db, text: str, post: schemas.Post, user: schemas.User,
+                         write_concern: Union[WriteConcern, None] = None):
     db_comment = schemas.Comment(text=text, post_id=str(post.id), author_id=str(user.id))
-    db_comment = jsonable_encoder(db_comment)
-    new_comment = await db['comments'].insert_one(db_comment)
-    created_comment = await db['comments'].find_one({'_id': new_comment.inserted_id})
-
-    post.comment_ids.append(created_comment['_id'])
-    update_result = await db['posts'].update_one({'_id': str(post.id)},
-                                                 {"$set": {"comment_ids": post.comment_ids}})
-    updated_post = await db['posts'].find_one({"_id": str(post.id)})
-
-    return schemas.Comment(**created_comment)
+    # the scope of the post is kept on its comments so that search can filter them by membership
+    await get_collection(db, 'comments', write_concern).insert_one({**jsonable_encoder(db_comment),
+                                                                    'scope_id': get_scope_id(post)})
+
+    await get_collection(db, 'posts', write_concern).update_one({'_id': str(post.id)},
+                                                                {"$inc": {"comment_count": 1}})
+    await bump_versions(db, [get_scope_id(post)])
+    await events.broker.publish(get_scope_id(post), events.COMMENT_CREATED, db_comment)
+
+    return db_comment
+
+
+async def create_comments(db, comments: list[schemas.Comment], write_concern: Union[WriteConcern, None] = None):
+    if not comments:
+        return comments
+    comment_counts = Counter(comment.post_id for comment in comments)
+    posts = await get_posts_by_ids(db, list(comment_counts), model=schemas.PostAccess)
+    scope_ids = {str(post.id): get_scope_id(post) for post in posts}
+    await get_collection(db, 'comments', write_concern).insert_many(
+        [{**jsonable_encoder(comment), 'scope_id': scope_ids.get(comment.post_id)} for comment in comments])
+
+    await get_collection(db, 'posts', write_concern).bulk_write(
+        [UpdateOne({'_id': post_id}, {"$inc": {"comment_count": count}}) for post_id, count in comment_counts.items()],
+        ordered=False)
+    await bump_versions(db, list(scope_ids.values()))
+    for comment in comments:
+        if comment.post_id in scope_ids:
+            await events.broker.publish(scope_ids[comment.post_id], events.COMMENT_CREATED, comment)
 
-
-async def get_comments_for_post(db, post: schemas.Post):
-    comments = await db['comments'].find({'post_id': str(post.id)}).to_list(1000)
     return comments
 
 
-async def get_comment(db, id: str):
-    comment = await db['comments'].find_one({"_id": id})
+async def get_comments_for_post(db, post: schemas.Post, limit: int = DEFAULT_PAGE_SIZE,
+                                after: Union[str, None] = None):
+    return await get_page(db['comments'], {'post_id': str(post.id)}, limit, after, descending=False,
+                          model=schemas.Comment)
+
+
+async def get_comments_for_posts(db, posts: list[dict]):
+    comments = await db['comments'].find({'post_id': {'$in': [post['_id'] for post in posts]}},
+                                         projection(schemas.Comment)).sort([('post_id', 1), ('_id', 1)]).to_list(None)
+    comments_by_post = defaultdict(list)
+    for comment in comments:
+        comments_by_post[comment['post_id']].append(comment)
+    return comments_by_post
+
+
+async def iter_posts_with_comments(db, query: dict, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield the posts matching `query` oldest first, each with a `comments` list.
+
+    Comments are read with one query per batch of posts, so memory use depends on
+    the batch size and not on the number of posts.
+    """
+    cursor = db['posts'].find(query, projection(schemas.Post)).sort('_id', 1).batch_size(batch_size)
+    while posts := await cursor.to_list(batch_size):
+        comments_by_post = await get_comments_for_posts(db, posts)
+        for post in posts:
+            yield {**post, 'comments': comments_by_post[post['_id']]}
+
+
+async def get_thread(db, post_id: str, limit: int = DEFAULT_PAGE_SIZE):
+    """Return the post with the first page of its comments and the cursor of the next page.
+
+    The comments are joined with `$lookup`, so the whole thread is one round trip.
+    """
+    pipeline = [
+        {'$match': {'_id': post_id}},
+        {'$project': projection(schemas.Post)},
+        {'$lookup': {'from': 'comments', 'localField': '_id', 'foreignField': 'post_id',
+                     'pipeline': [{'$sort': {'_id': 1}}, {'$limit': limit + 1},
+                                  {'$project': projection(schemas.Comment)}],
+                     'as': 'comments'}},
+    ]
+    threads = await db['posts'].aggregate(pipeline).to_list(1)
+    if not threads:
+        return None, None
+    thread = threads[0]
+    next_cursor = None
+    if len(thread['comments']) > limit:
+        thread['comments'] = thread['comments'][:limit]
+        next_cursor = thread['comments'][-1]['_id']
+    return thread, next_cursor
+
+
+async def get_comment_access(db, id: str):
+    """Return the access fields of the comment and of its post, read in one round trip."""
+    pipeline = [
+        {'$match': {'_id': id}},
+        {'$project': projection(schemas.CommentAccess)},
+        {'$lookup': {'from': 'posts', 'localField': 'post_id', 'foreignField': '_id',
+                     'pipeline': [{'$project': projection(schemas.PostAccess)}],
+                     'as': 'posts'}},
+    ]
+    comments = await db['comments'].aggregate(pipeline).to_list(1)
+    if not comments or not comments[0]['posts']:
+        return None, None
+    return schemas.CommentAccess(**comments[0]), schemas.PostAccess(**comments[0]['posts'][0])
+
+
+async def get_comment(db, id: str, model=schemas.Comment):
+    comment = await db['comments'].find_one({"_id": id}, projection(model))
     if comment is None:
         return None
-    return schemas.Comment(**comment)
+    return model(**comment)
 
 
 async def remove_comment(db, comment: schemas.Comment):
     result = await db['comments'].delete_one({'_id': str(comment.id)})
+    if result.deleted_count:
+        post = await db['posts'].find_one_and_update({'_id': comment.post_id}, {"$inc": {"comment_count": -1}},
+                                                     projection(schemas.PostAccess))
+        likes.buffer.discard_target(LIKE_COMMENT, str(comment.id))
+        await db['likes'].delete_many({'target_type': LIKE_COMMENT, 'target_id': str(comment.id)})
+        if post is not None:
+            scope_id = get_scope_id(schemas.PostAccess(**post))
+            await bump_versions(db, [scope_id])
+            await events.broker.publish(scope_id, events.COMMENT_DELETED,
+                                        {'_id': str(comment.id), 'post_id': comment.post_id})
     return result
 
 
-async def like_comment(db, comment: schemas.Comment, user: schemas.User):
-    user.likes_comment_ids.append(str(comment.id))
-    update_result = await db['users'].update_one({'_id': str(user.id)},
-                                                 {"$set": {"likes_comment_ids": user.likes_comment_ids}})
-    updated_user = await db['users'].find_one({"_id": str(user.id)})
-
-    comment.likes_user_ids.append(str(user.id))
-    update_result = await db['comments'].update_one({'_id': str(comment.id)},
-                                                 {"$set": {"likes_user_ids": comment.likes_user_ids}})
-    updated_comment = await db['comments'].find_one({"_id": str(comment.id)})
-
-    return updated_user, updated_comment
-
-
-async def remove_like_from_comment(db, comment: schemas.Comment, user: schemas.User):
-    user.likes_comment_ids.remove(str(comment.id))
-    update_result = await db['users'].update_one({'_id': str(user.id)},
-                                                 {"$set": {"likes_comment_ids": user.likes_comment_ids}})
-    updated_user = await db['users'].find_one({"_id": str(user.id)})
+async def like_comment(db, comment: schemas.Comment, post: schemas.Post, user: schemas.User):
+    if likes.LIKE_WRITE_BEHIND:
+        if not await buffer_like(db, user, LIKE_COMMENT, str(comment.id), True):
+            return None
+        return await get_buffered(db, 'comments', LIKE_COMMENT, str(comment.id), schemas.Comment)
+    if not await add_like(db, user, LIKE_COMMENT, str(comment.id)):
+        return None
+    updated_comment = await update_like_count(db, user, 'comments', LIKE_COMMENT, str(comment.id), 1)
+    await events.broker.publish(get_scope_id(post), events.COMMENT_UPDATED, updated_comment)
+    return updated_comment
 
-    comment.likes_user_ids.remove(str(user.id))
-    update_result = await db['comments'].update_one({'_id': str(comment.id)},
-                                                 {"$set": {"likes_user_ids": comment.likes_user_ids}})
-    updated_comment = await db['comments'].find_one({"_id": str(comment.id)})
 
-    return updated_user, updated_comment
+async def remove_like_from_comment(db, comment: schemas.Comment, post: schemas.Post, user: schemas.User):
+    if likes.LIKE_WRITE_BEHIND:
+        if not await buffer_like(db, user, LIKE_COMMENT, str(comment.id), False):
+            return None
+        return await get_buffered(db, 'comments', LIKE_COMMENT, str(comment.id), schemas.Comment)
+    if not await delete_like(db, user, LIKE_COMMENT, str(comment.id)):
+        return None
+    updated_comment = await update_like_count(db, user, 'comments', LIKE_COMMENT, str(comment.id), -1)
+    await events.broker.publish(get_scope_id(post), events.COMMENT_UPDATED, updated_comment)
+    return updated_comment
@@ -1,6 +1,90 @@
 import os
+import time
 import motor.motor_asyncio
+from pymongo.read_preferences import SecondaryPreferred
+
+import metrics
 
 MONGODB_CONNECTION_STR = os.getenv("CUSTOMCONNSTR_MONGODB")
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_CONNECTION_STR)
-db = client.pa200db
\ No newline at end of file
+DATABASE_NAME = "pa200db"
+
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "10000"))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000"))
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+# comma separated, e.g. "zstd,zlib"; zstd and snappy need the pymongo extras of the same name
+MONGODB_COMPRESSORS = os.getenv("MONGODB_COMPRESSORS", "")
+
+# send the reads that tolerate some lag (walls, comments, catalogs, exports, search) to secondaries
+MONGODB_SECONDARY_READS = os.getenv("MONGODB_SECONDARY_READS", "").lower() in ("1", "true", "yes")
+MONGODB_MAX_STALENESS_SECONDS = int(os.getenv("MONGODB_MAX_STALENESS_SECONDS", "90"))
+
+client = None
+
+
+def connect():
+    global client
+    if client is None:
+        options = {}
+        if MONGODB_COMPRESSORS:
+            options["compressors"] = MONGODB_COMPRESSORS
+        client = motor.motor_asyncio.AsyncIOMotorClient(
+            MONGODB_CONNECTION_STR, event_listeners=metrics.event_listeners,
+            maxPoolSize=MONGODB_MAX_POOL_SIZE, minPoolSize=MONGODB_MIN_POOL_SIZE,
+            connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS, serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+            socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS, waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS, **options)
+    return client
+
+
+def close():
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+
+class Database:
+    """The application database on the client opened by `connect`.
+
+    Modules import `db` once, so the client itself can be created when the application
+    starts and closed when it stops; scripts that never call `connect` get a client on
+    first use.
+    """
+
+    def __init__(self, read_preference=None):
+        self.read_preference = read_preference
+        self.database = None
+
+    def get(self):
+        current = connect()
+        if self.database is None or self.database.client is not current:
+            self.database = current.get_database(DATABASE_NAME, read_preference=self.read_preference)
+        return self.database
+
+    def __getitem__(self, name: str):
+        return self.get()[name]
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+db = Database()
+if MONGODB_SECONDARY_READS:
+    read_db = Database(SecondaryPreferred(max_staleness=MONGODB_MAX_STALENESS_SECONDS))
+else:
+    read_db = db
+
+
+def read_epoch():
+    """Changes every `MONGODB_MAX_STALENESS_SECONDS` when reads go to secondaries, otherwise always 0.
+
+    ETags include it: a response read from a lagging secondary can be older than the
+    versions its ETag was computed from, and this bounds how long clients keep it.
+    """
+    if read_db is db:
+        return 0
+    return int(time.time() // MONGODB_MAX_STALENESS_SECONDS)
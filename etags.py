@@ -0,0 +1,23 @@
+import hashlib
+
+from fastapi import Request, Response
+
+import database
+
+
+def make_etag(*parts):
+    # the bodies these tags describe are read from `database.read_db`
+    parts += (database.read_epoch(),)
+    return 'W/"%s"' % hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def is_not_modified(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def not_modified_response(etag: str):
+    return Response(status_code=304, headers={"ETag": etag})
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+from pymongo import ASCENDING, IndexModel
+
+import serialization
+
+# "memory" delivers events within this process; "mongodb" shares them between processes
+# through a change stream on the `events` collection, which needs a replica set
+EVENTS_BROKER = os.getenv("EVENTS_BROKER", "memory")
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", "15"))
+EVENT_RETENTION_SECONDS = 3600
+
+POST_CREATED = "post_created"
+POST_UPDATED = "post_updated"
+POST_DELETED = "post_deleted"
+COMMENT_CREATED = "comment_created"
+COMMENT_UPDATED = "comment_updated"
+COMMENT_DELETED = "comment_deleted"
+# sent instead of the events a subscriber was too slow to receive; the client should reload the wall
+RESYNC = "resync"
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class Subscription:
+
+    def __init__(self, scope_ids: set[str], queue_size: int):
+        self.scope_ids = scope_ids
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.resyncs = 0
+
+    def deliver(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # the client is not keeping up; keep memory bounded and tell it to reload instead
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": RESYNC})
+            self.resyncs += 1
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class InProcessBroker:
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscriptions = defaultdict(set)
+        self.published = 0
+        self.delivered = 0
+        self.resyncs = 0
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, scope_ids: list[str]):
+        subscription = Subscription(set(scope_ids), self.queue_size)
+        for scope_id in subscription.scope_ids:
+            self.subscriptions[scope_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.resyncs += subscription.resyncs
+        for scope_id in subscription.scope_ids:
+            self.subscriptions[scope_id].discard(subscription)
+            if not self.subscriptions[scope_id]:
+                del self.subscriptions[scope_id]
+
+    async def publish(self, scope_id: str, type: str, data: dict):
+        self.dispatch({"type": type, "scope_id": scope_id, "data": jsonable_encoder(data)})
+
+    def dispatch(self, event: dict):
+        self.published += 1
+        for subscription in self.subscriptions.get(event["scope_id"], ()):
+            subscription.deliver(event)
+            self.delivered += 1
+
+    def resync_all(self):
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                subscription.deliver({"type": RESYNC})
+
+    def stats(self):
+        return {"subscriptions": sum(len(subscriptions) for subscriptions in self.subscriptions.values()),
+                "published": self.published, "delivered": self.delivered, "resyncs": self.resyncs}
+
+
+class ChangeStreamBroker(InProcessBroker):
+    """Share events between processes through MongoDB.
+
+    Publishing inserts the event into the `events` collection; every process watches
+    that collection with a change stream and delivers the inserted events to its own
+    subscribers. Old events are removed by a TTL index.
+    """
+
+    def __init__(self, db, queue_size: int):
+        super().__init__(queue_size)
+        self.db = db
+        self.task = None
+
+    async def start(self):
+        await self.db['events'].create_indexes([IndexModel([("created_at", ASCENDING)], name="created_at_ttl",
+                                                           expireAfterSeconds=EVENT_RETENTION_SECONDS)])
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def publish(self, scope_id: str, type: str, data: dict):
+        await self.db['events'].insert_one({"type": type, "scope_id": scope_id, "data": jsonable_encoder(data),
+                                            "created_at": datetime.utcnow()})
+
+    async def run(self):
+        while True:
+            try:
+                async with self.db['events'].watch([{"$match": {"operationType": "insert"}}]) as stream:
+                    async for change in stream:
+                        document = change["fullDocument"]
+                        self.dispatch({"type": document["type"], "scope_id": document["scope_id"],
+                                       "data": document["data"]})
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Event change stream failed, reconnecting")
+                # events published until the stream is reopened are lost
+                self.resync_all()
+                await asyncio.sleep(1)
+
+
+async def event_stream(broker, scope_ids: list[str]):
+    """Server-sent events for the given courses and classes, with periodic keep-alive comments."""
+    subscription = broker.subscribe(scope_ids)
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), EVENT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            yield b"event: " + event["type"].encode() + b"\ndata: " + serialization.dumps(event) + b"\n\n"
+    finally:
+        broker.unsubscribe(subscription)
+
+
+if EVENTS_BROKER == "mongodb":
+    from database import db
+
+    broker = ChangeStreamBroker(db, EVENT_QUEUE_SIZE)
+else:
+    broker = InProcessBroker(EVENT_QUEUE_SIZE)
@@ -0,0 +1,92 @@
+import asyncio
+import sys
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+import crud
+from database import db
+
+
+INDEXES = {
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "posts": [
+        IndexModel([("course_id", ASCENDING), ("_id", DESCENDING)], name="course_id_id"),
+        IndexModel([("class_id", ASCENDING), ("_id", DESCENDING)], name="class_id_id"),
+        IndexModel([("text", TEXT), ("course_id", ASCENDING), ("class_id", ASCENDING)], name="text"),
+    ],
+    "comments": [
+        IndexModel([("post_id", ASCENDING), ("_id", ASCENDING)], name="post_id_id"),
+        IndexModel([("text", TEXT), ("scope_id", ASCENDING)], name="text"),
+    ],
+    "likes": [
+        IndexModel([("user_id", ASCENDING), ("target_type", ASCENDING), ("target_id", ASCENDING)],
+                   name="user_id_target_unique", unique=True),
+        IndexModel([("target_type", ASCENDING), ("target_id", ASCENDING)], name="target"),
+    ],
+    "timelines": [
+        IndexModel([("fan_out_scope_ids", ASCENDING)], name="fan_out_scope_ids"),
+    ],
+}
+
+SAMPLE_ID = "000000000000000000000000"
+
+# (collection, filter, sort) of every query issued by crud.py apart from the `_id` point reads
+QUERY_SHAPES = {
+    "get_user": ("users", {"username": "sample"}, None),
+    "get_posts_for_course": ("posts", {"course_id": SAMPLE_ID, "_id": {"$lt": SAMPLE_ID}}, [("_id", DESCENDING)]),
+    "get_posts_for_class": ("posts", {"class_id": SAMPLE_ID, "_id": {"$lt": SAMPLE_ID}}, [("_id", DESCENDING)]),
+    "get_wall": ("posts", {"$or": [{"class_id": {"$in": [SAMPLE_ID]}}, {"course_id": {"$in": [SAMPLE_ID]}}],
+                           "_id": {"$lt": SAMPLE_ID}}, [("_id", DESCENDING)]),
+    "get_comments_for_post": ("comments", {"post_id": SAMPLE_ID, "_id": {"$gt": SAMPLE_ID}}, [("_id", ASCENDING)]),
+    "iter_posts_with_comments": ("posts", {"course_id": SAMPLE_ID}, [("_id", ASCENDING)]),
+    "get_comments_for_posts": ("comments", {"post_id": {"$in": [SAMPLE_ID]}}, [("post_id", ASCENDING), ("_id", ASCENDING)]),
+    "get_liked_ids": ("likes", {"user_id": SAMPLE_ID, "target_type": "post", "target_id": {"$in": [SAMPLE_ID]}}, None),
+    "fan_out_posts": ("timelines", {"fan_out_scope_ids": SAMPLE_ID}, None),
+    "search_posts": ("posts", {"$text": {"$search": "sample"}, "$or": [{"class_id": {"$in": [SAMPLE_ID]}},
+                                                                      {"course_id": {"$in": [SAMPLE_ID]}}]}, None),
+    "search_comments": ("comments", {"$text": {"$search": "sample"}, "scope_id": {"$in": [SAMPLE_ID]}}, None),
+    "unset_comment_scopes": ("comments", {"post_id": SAMPLE_ID}, None),
+    "delete_likes_of_target": ("likes", {"target_type": "post", "target_id": SAMPLE_ID}, None),
+}
+
+
+async def ensure_indexes(db):
+    for collection, indexes in INDEXES.items():
+        await db[collection].create_indexes(indexes)
+
+
+def find_stages(plan, stage: str):
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage:
+            yield plan
+        for value in plan.values():
+            yield from find_stages(value, stage)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from find_stages(item, stage)
+
+
+async def verify_indexes(db):
+    collection_scans = []
+    for name, (collection, query, sort) in QUERY_SHAPES.items():
+        cursor = db[collection].find(query).limit(crud.DEFAULT_PAGE_SIZE + 1)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        if any(find_stages(explanation["queryPlanner"]["winningPlan"], "COLLSCAN")):
+            collection_scans.append(name)
+    return collection_scans
+
+
+async def main():
+    await ensure_indexes(db)
+    collection_scans = await verify_indexes(db)
+    for name in QUERY_SHAPES:
+        print(f"{name}: {'COLLSCAN' if name in collection_scans else 'ok'}")
+    return 1 if collection_scans else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
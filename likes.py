@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+import metrics
+
+# buffer likes and unlikes in memory and write them in batches, see LikeBuffer
+LIKE_WRITE_BEHIND = os.getenv("LIKE_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+LIKE_FLUSH_INTERVAL_SECONDS = float(os.getenv("LIKE_FLUSH_INTERVAL_SECONDS", "1"))
+# a flush starts early once this many (user, target) pairs are waiting
+LIKE_BUFFER_SIZE = int(os.getenv("LIKE_BUFFER_SIZE", "5000"))
+
+logger = logging.getLogger('uvicorn.error')
+
+flush_duration = metrics.registry.register(metrics.Histogram(
+    "like_flush_duration_seconds", "Time spent writing a batch of buffered likes."))
+
+
+class LikeBuffer:
+    """Likes and unlikes waiting to be written, keyed by (user_id, target_type, target_id).
+
+    Each pair keeps only the state it should end in, so a burst of toggles by one user
+    is one write, or none when it ends where it started. `write` is called with a batch
+    of `{pair: liked}` every `LIKE_FLUSH_INTERVAL_SECONDS`, when the buffer fills up,
+    and on shutdown.
+    """
+
+    def __init__(self, flush_interval: float, size: int):
+        self.flush_interval = flush_interval
+        self.size = size
+        # pair -> (liked in the database, liked after the write)
+        self.pending = {}
+        self.flushing = {}
+        # (target_type, target_id) -> change of the like count not written yet
+        self.deltas = Counter()
+        self.write = None
+        # created by start, on the event loop that serves the requests
+        self.full = None
+        self.stopping = False
+        self.task = None
+        self.recorded = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+
+    def get(self, pair: tuple):
+        """Whether the pair is liked according to the buffer, or None when the database has to be asked."""
+        for changes in (self.pending, self.flushing):
+            if pair in changes:
+                return changes[pair][1]
+        return None
+
+    def record(self, pair: tuple, liked: bool):
+        """Buffer a change of the pair to `liked`; returns False when it is already in that state."""
+        if self.get(pair) == liked:
+            return False
+        if pair in self.pending:
+            stored = self.pending[pair][0]
+        elif pair in self.flushing:
+            stored = self.flushing[pair][1]
+        else:
+            stored = not liked
+        self.recorded += 1
+        if pair in self.pending:
+            self.coalesced += 1
+        if stored == liked:
+            del self.pending[pair]
+        else:
+            self.pending[pair] = (stored, liked)
+        self.deltas[pair[1:]] += 1 if liked else -1
+        if len(self.pending) >= self.size and self.full is not None:
+            self.full.set()
+        return True
+
+    def delta(self, target_type: str, target_id: str):
+        return self.deltas[(target_type, target_id)]
+
+    def discard_target(self, target_type: str, target_id: str):
+        # a batch being written keeps its copy; `write` has to leave out targets deleted meanwhile
+        for changes in (self.pending, self.flushing):
+            for pair in [pair for pair in changes if pair[1:] == (target_type, target_id)]:
+                del changes[pair]
+        self.deltas.pop((target_type, target_id), None)
+
+    async def start(self, write):
+        self.write = write
+        self.full = asyncio.Event()
+        self.stopping = False
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.stopping = True
+        self.full.set()
+        await self.task
+
+    async def run(self):
+        metrics.current_route.set("like-buffer")
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+        await self.flush()
+
+    async def flush(self):
+        self.full.clear()
+        if not self.pending:
+            return
+        self.flushing, self.pending = self.pending, {}
+        start = time.perf_counter()
+        try:
+            await self.write({pair: liked for pair, (stored, liked) in self.flushing.items()})
+        except Exception:
+            logger.exception("Failed to write %d buffered likes, retrying with the next flush", len(self.flushing))
+            self.failed += len(self.flushing)
+            self.restore()
+        else:
+            self.written += len(self.flushing)
+            for (user_id, target_type, target_id), (stored, liked) in self.flushing.items():
+                self.deltas[(target_type, target_id)] -= 1 if liked else -1
+            self.deltas = Counter({target: delta for target, delta in self.deltas.items() if delta})
+        self.flushing = {}
+        flush_duration.observe((), time.perf_counter() - start)
+
+    def restore(self):
+        # changes recorded during the failed write were based on the state it would have written
+        for pair, (stored, liked) in self.flushing.items():
+            if pair in self.pending:
+                liked = self.pending[pair][1]
+            if stored == liked:
+                self.pending.pop(pair, None)
+            else:
+                self.pending[pair] = (stored, liked)
+
+    def stats(self):
+        return {"queued": len(self.pending), "flushing": len(self.flushing), "recorded": self.recorded,
+                "coalesced": self.coalesced, "written": self.written, "failed": self.failed}
+
+
+buffer = LikeBuffer(LIKE_FLUSH_INTERVAL_SECONDS, LIKE_BUFFER_SIZE)
@@ -0,0 +1,243 @@
+import threading
+import time
+from contextvars import ContextVar
+
+from pymongo import monitoring
+from starlette.routing import Match
+
+
+# route template of the request being handled, e.g. "/post/{post_id}/like"
+current_route = ContextVar("current_route", default="none")
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def format_labels(labelnames: tuple, labels: tuple):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labelnames, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, labels: tuple, value: float):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        return [(self.name, self.labelnames, labels, value) for labels, value in self.callback().items()]
+
+
+class Histogram:
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [observations per bucket (the last one is +Inf), sum of observed values]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = next((index for index, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self.values[labels] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        bucket_labelnames = self.labelnames + ("le",)
+        with self.lock:
+            for labels, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", bucket_labelnames, labels + (bound,), cumulative))
+                samples.append((f"{self.name}_sum", self.labelnames, labels, total))
+                samples.append((f"{self.name}_count", self.labelnames, labels, cumulative))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labelnames, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labelnames, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests.", ("route", "method", "status")))
+mongodb_commands = registry.register(Counter(
+    "mongodb_commands_total", "MongoDB commands sent, by the route that sent them.", ("route", "command", "status")))
+mongodb_command_duration = registry.register(Histogram(
+    "mongodb_command_duration_seconds", "Duration of MongoDB commands.", ("route", "command")))
+mongodb_documents_returned = registry.register(Counter(
+    "mongodb_documents_returned_total", "Documents returned by MongoDB commands.", ("route", "command")))
+mongodb_pool_connections = registry.register(Gauge(
+    "mongodb_pool_connections", "Connections in the MongoDB connection pools.", ("address", "state")))
+
+
+def register_stats(name: str, documentation: str, stats):
+    registry.register(Gauge(name, documentation, ("stat",),
+                            callback=lambda: {(stat,): value for stat, value in stats().items()}))
+
+
+def returned_documents(reply: dict):
+    if "cursor" in reply:
+        return len(reply["cursor"].get("firstBatch", reply["cursor"].get("nextBatch", [])))
+    if "value" in reply:
+        return 1 if reply["value"] is not None else 0
+    return 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+
+    def __init__(self):
+        self.routes = {}
+
+    def started(self, event):
+        # succeeded/failed may be reported outside of the request context, so the route is remembered here
+        self.routes[(event.connection_id, event.request_id)] = current_route.get()
+
+    def succeeded(self, event):
+        route = self.routes.pop((event.connection_id, event.request_id), current_route.get())
+        mongodb_commands.inc((route, event.command_name, "succeeded"))
+        mongodb_command_duration.observe((route, event.command_name), event.duration_micros / 1e6)
+        mongodb_documents_returned.inc((route, event.command_name), returned_documents(event.reply))
+
+    def failed(self, event):
+        route = self.routes.pop((event.connection_id, event.request_id), current_route.get())
+        mongodb_commands.inc((route, event.command_name, "failed"))
+        mongodb_command_duration.observe((route, event.command_name), event.duration_micros / 1e6)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+
+    def change(self, event, state: str, delta: int):
+        address = "%s:%s" % event.address
+        with mongodb_pool_connections.lock:
+            labels = (address, state)
+            mongodb_pool_connections.values[labels] = mongodb_pool_connections.values.get(labels, 0) + delta
+
+    def connection_created(self, event):
+        self.change(event, "open", 1)
+
+    def connection_closed(self, event):
+        self.change(event, "open", -1)
+
+    def connection_checked_out(self, event):
+        self.change(event, "checked_out", 1)
+
+    def connection_checked_in(self, event):
+        self.change(event, "checked_out", -1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+
+event_listeners = [CommandMetrics(), PoolMetrics()]
+
+
+def route_for(scope):
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = route_for(scope)
+        token = current_route.set(route)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_request_duration.observe((route, scope["method"], status), time.perf_counter() - start)
+            current_route.reset(token)
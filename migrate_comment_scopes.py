@@ -0,0 +1,29 @@
+import asyncio
+
+from pymongo import UpdateMany
+
+import crud
+import indexes
+import schemas
+from database import db
+
+
+BATCH_SIZE = 1000
+
+
+async def migrate_comment_scopes(db):
+    await indexes.ensure_indexes(db)
+
+    updates = []
+    async for post in db['posts'].find({}, crud.projection(schemas.PostAccess)):
+        updates.append(UpdateMany({'post_id': post['_id'], 'scope_id': {'$exists': False}},
+                                  {'$set': {'scope_id': crud.get_scope_id(schemas.PostAccess(**post))}}))
+        if len(updates) >= BATCH_SIZE:
+            await db['comments'].bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db['comments'].bulk_write(updates, ordered=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate_comment_scopes(db))
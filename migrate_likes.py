@@ -0,0 +1,82 @@
+import asyncio
+
+from fastapi.encoders import jsonable_encoder
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import crud
+import indexes
+import schemas
+from database import db
+
+
+BATCH_SIZE = 1000
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def insert_likes(db, likes: list[dict]):
+    if not likes:
+        return
+    try:
+        await db['likes'].bulk_write([InsertOne(like) for like in likes], ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+
+
+async def copy_likes(db, collection: str, field: str, build_like):
+    likes = []
+    async for document in db[collection].find({field: {'$exists': True, '$ne': []}}, {field: 1}):
+        for other_id in document[field]:
+            likes.append(jsonable_encoder(build_like(str(document['_id']), other_id)))
+        if len(likes) >= BATCH_SIZE:
+            await insert_likes(db, likes)
+            likes = []
+    await insert_likes(db, likes)
+
+
+async def set_counts(db, collection: str, field: str, source: str, pipeline: list[dict]):
+    await db[collection].update_many({}, {'$set': {field: 0}})
+    updates = []
+    async for group in db[source].aggregate(pipeline):
+        updates.append(UpdateOne({'_id': group['_id']}, {'$set': {field: group['count']}}))
+        if len(updates) >= BATCH_SIZE:
+            await db[collection].bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db[collection].bulk_write(updates, ordered=False)
+
+
+def count_likes(target_type: str):
+    return [{'$match': {'target_type': target_type}},
+            {'$group': {'_id': '$target_id', 'count': {'$sum': 1}}}]
+
+
+async def migrate_likes(db):
+    await indexes.ensure_indexes(db)
+
+    await copy_likes(db, 'posts', 'likes_user_ids',
+                     lambda post_id, user_id: schemas.Like(user_id=user_id, target_type=crud.LIKE_POST,
+                                                           target_id=post_id))
+    await copy_likes(db, 'comments', 'likes_user_ids',
+                     lambda comment_id, user_id: schemas.Like(user_id=user_id, target_type=crud.LIKE_COMMENT,
+                                                              target_id=comment_id))
+    await copy_likes(db, 'users', 'likes_post_ids',
+                     lambda user_id, post_id: schemas.Like(user_id=user_id, target_type=crud.LIKE_POST,
+                                                           target_id=post_id))
+    await copy_likes(db, 'users', 'likes_comment_ids',
+                     lambda user_id, comment_id: schemas.Like(user_id=user_id, target_type=crud.LIKE_COMMENT,
+                                                              target_id=comment_id))
+
+    await set_counts(db, 'posts', 'like_count', 'likes', count_likes(crud.LIKE_POST))
+    await set_counts(db, 'comments', 'like_count', 'likes', count_likes(crud.LIKE_COMMENT))
+    await set_counts(db, 'posts', 'comment_count', 'comments',
+                     [{'$group': {'_id': '$post_id', 'count': {'$sum': 1}}}])
+
+    await db['posts'].update_many({}, {'$unset': {'likes_user_ids': '', 'comment_ids': ''}})
+    await db['comments'].update_many({}, {'$unset': {'likes_user_ids': ''}})
+    await db['users'].update_many({}, {'$unset': {'likes_post_ids': '', 'likes_comment_ids': ''}})
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate_likes(db))
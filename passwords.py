@@ -0,0 +1,38 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+
+PASSWORD_HASHING_WORKERS = int(os.getenv("PASSWORD_HASHING_WORKERS", "4"))
+PASSWORD_HASHING_PROCESSES = int(os.getenv("PASSWORD_HASHING_PROCESSES", str(os.cpu_count() or 1)))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt releases the GIL, so hashing in threads keeps the event loop responsive
+executor = ThreadPoolExecutor(max_workers=PASSWORD_HASHING_WORKERS, thread_name_prefix="password-hashing")
+# bulk hashing (roster imports) gets its own processes, started on first use
+process_executor = None
+
+
+def hash_password_sync(password: str):
+    return pwd_context.hash(password)
+
+
+async def hash_password(password: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, pwd_context.hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, pwd_context.verify, plain_password, hashed_password)
+
+
+async def hash_passwords(passwords: list[str]):
+    global process_executor
+    if process_executor is None:
+        process_executor = ProcessPoolExecutor(max_workers=PASSWORD_HASHING_PROCESSES)
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[loop.run_in_executor(process_executor, hash_password_sync, password)
+                                  for password in passwords])
@@ -0,0 +1,123 @@
+from fastapi import Depends, HTTPException
+
+import crud
+import schemas
+from auth import get_current_active_user
+from database import db
+
+
+def invalid_course():
+    return HTTPException(status_code=400,
+                         detail="Invalid course ID; either does not exist, or user does not have an access")
+
+
+def invalid_class():
+    return HTTPException(status_code=400,
+                         detail="Invalid class ID; either does not exist, or user does not have an access")
+
+
+class Authorizer:
+    """Access checks for the user making the current request.
+
+    The user's memberships are turned into sets once, and posts, comments, courses
+    and classes read for a check are kept for the rest of the request, so asking
+    about the same object twice does not query the database again.
+    """
+
+    def __init__(self, db, user: schemas.UserPermissions):
+        self.db = db
+        self.user = user
+        self.user_id = str(user.id)
+        self.course_ids = frozenset(user.course_ids)
+        self.class_ids = frozenset(user.class_ids)
+        self.posts = {}
+        self.comments = {}
+        self.scopes = {}
+
+    def is_member(self, post: schemas.PostAccess):
+        return post.class_id in self.class_ids or post.course_id in self.course_ids
+
+    def can_access_post(self, post: schemas.PostAccess):
+        return post.author_id == self.user_id or self.is_member(post)
+
+    def can_delete_post(self, post: schemas.PostAccess):
+        return post.author_id == self.user_id or (self.user.is_teacher and self.is_member(post))
+
+    def can_access_comment(self, comment: schemas.CommentAccess, post: schemas.PostAccess):
+        return comment.author_id == self.user_id or self.is_member(post)
+
+    async def load_posts(self, post_ids: list[str]):
+        missing_ids = [id for id in set(post_ids) if id not in self.posts]
+        if missing_ids:
+            for post in await crud.get_posts_by_ids(self.db, missing_ids, model=schemas.PostAccess):
+                self.posts[str(post.id)] = post
+            for id in missing_ids:
+                self.posts.setdefault(id, None)
+        return {id: self.posts[id] for id in post_ids}
+
+    async def get_post(self, post_id: str):
+        post = (await self.load_posts([post_id]))[post_id]
+        if post is None:
+            raise HTTPException(status_code=400, detail="Invalid post ID")
+        return post
+
+    def check_post_access(self, post: schemas.PostAccess):
+        if not self.can_access_post(post):
+            raise HTTPException(status_code=403, detail="User does not have an access to given post")
+
+    async def accessible_post(self, post_id: str):
+        post = await self.get_post(post_id)
+        self.check_post_access(post)
+        return post
+
+    async def deletable_post(self, post_id: str):
+        post = await self.get_post(post_id)
+        if not self.can_delete_post(post):
+            raise HTTPException(status_code=403, detail="User does not have permissions to delete this post")
+        return post
+
+    async def accessible_comment(self, comment_id: str):
+        if comment_id not in self.comments:
+            comment, post = await crud.get_comment_access(self.db, comment_id)
+            self.comments[comment_id] = comment
+            if post is not None:
+                self.posts[str(post.id)] = post
+        comment = self.comments[comment_id]
+        if comment is None:
+            raise HTTPException(status_code=400, detail="Invalid comment ID")
+        post = self.posts[comment.post_id]
+        if not self.can_access_comment(comment, post):
+            raise HTTPException(status_code=403, detail="User does not have an access to the given comment")
+        return comment, post
+
+    def check_course_member(self, course_id: str):
+        if course_id not in self.course_ids:
+            raise invalid_course()
+
+    def check_class_member(self, class_id: str):
+        if class_id not in self.class_ids:
+            raise invalid_class()
+
+    async def member_course(self, course_id: str):
+        self.check_course_member(course_id)
+        if course_id not in self.scopes:
+            self.scopes[course_id] = await crud.get_course(self.db, course_id, model=schemas.CatalogItem)
+        if self.scopes[course_id] is None:
+            raise invalid_course()
+        return self.scopes[course_id]
+
+    async def member_class(self, class_id: str):
+        self.check_class_member(class_id)
+        if class_id not in self.scopes:
+            self.scopes[class_id] = await crud.get_class(self.db, class_id, model=schemas.CatalogItem)
+        if self.scopes[class_id] is None:
+            raise invalid_class()
+        return self.scopes[class_id]
+
+    def require_teacher(self, detail: str):
+        if not self.user.is_teacher:
+            raise HTTPException(status_code=403, detail=detail)
+
+
+async def get_authorizer(current_user: schemas.UserPermissions = Depends(get_current_active_user)):
+    return Authorizer(db, current_user)
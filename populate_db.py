@@ -1,72 +1,184 @@
-import asyncio
+"""Fill the database with a reproducible synthetic dataset.
+
+Every user is enrolled in one class and `--courses-per-user` courses, every course
+and class wall gets `--posts-per-wall` posts written by its members, and posts get
+on average `--comments-per-post` comments. Like counts follow a Zipf-like
+distribution, so most posts have few likes and a handful are very popular. The
+same `--seed` always produces the same dataset, including IDs.
 
-from time import sleep
+    python populate_db.py --users 20000 --classes 600 --courses 400 --posts-per-wall 2500
+"""
+import argparse
+import asyncio
+import random
+import time
+from itertools import accumulate
 
 import crud
-import schemas as schemas
+import indexes
 from database import db
+from passwords import hash_password
+
+
+BASE_TIMESTAMP = 1672531200  # 2023-01-01
+
+
+class IdGenerator:
+
+    def __init__(self):
+        self.counter = 0
+
+    def __call__(self, timestamp: int):
+        self.counter += 1
+        return f"{timestamp:08x}{self.counter:016x}"
+
+
+class BatchWriter:
+
+    def __init__(self, db, batch_size: int, concurrency: int):
+        self.db = db
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.buffers = {}
+        self.tasks = set()
+        self.written = {}
+
+    async def add(self, collection: str, document: dict):
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(document)
+        if len(buffer) >= self.batch_size:
+            await self.flush(collection)
+
+    async def flush(self, collection: str):
+        documents = self.buffers.pop(collection, [])
+        if not documents:
+            return
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self.insert(collection, documents))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def insert(self, collection: str, documents: list[dict]):
+        try:
+            await self.db[collection].insert_many(documents, ordered=False)
+            self.written[collection] = self.written.get(collection, 0) + len(documents)
+        finally:
+            self.semaphore.release()
+
+    async def close(self):
+        for collection in list(self.buffers):
+            await self.flush(collection)
+        await asyncio.gather(*self.tasks)
+
+
+def zipf_cum_weights(max_value: int, exponent: float):
+    return list(accumulate(1 / (value + 1) ** exponent for value in range(max_value + 1)))
+
+
+def sample_count(rng: random.Random, cum_weights: list[float], limit: int):
+    return min(rng.choices(range(len(cum_weights)), cum_weights=cum_weights)[0], limit)
+
+
+async def add_likes(writer: BatchWriter, rng: random.Random, new_id: IdGenerator, timestamp: int,
+                    target_type: str, target_id: str, members: list[str], count: int):
+    for user_id in rng.sample(members, count):
+        await writer.add("likes", {"_id": new_id(timestamp), "user_id": user_id,
+                                   "target_type": target_type, "target_id": target_id})
+
+
+async def populate_wall(writer: BatchWriter, rng: random.Random, new_id: IdGenerator, args,
+                        post_likes: list[float], comment_likes: list[float],
+                        scope_field: str, scope_id: str, members: list[str]):
+    if not members:
+        return
+    for _ in range(args.posts_per_wall):
+        timestamp = BASE_TIMESTAMP + rng.randrange(args.days * 86400)
+        post_id = new_id(timestamp)
+        comment_count = rng.randint(0, 2 * args.comments_per_post)
+        like_count = sample_count(rng, post_likes, len(members))
+        await writer.add("posts", {"_id": post_id, "text": f"Post {post_id}", "author_id": rng.choice(members),
+                                   "course_id": None, "class_id": None, scope_field: scope_id,
+                                   "like_count": like_count, "comment_count": comment_count})
+        await add_likes(writer, rng, new_id, timestamp, crud.LIKE_POST, post_id, members, like_count)
+
+        for _ in range(comment_count):
+            timestamp += rng.randrange(1, 3600)
+            comment_id = new_id(timestamp)
+            comment_like_count = sample_count(rng, comment_likes, len(members))
+            await writer.add("comments", {"_id": comment_id, "text": f"Comment {comment_id}",
+                                          "author_id": rng.choice(members), "post_id": post_id,
+                                          "scope_id": scope_id, "like_count": comment_like_count})
+            await add_likes(writer, rng, new_id, timestamp, crud.LIKE_COMMENT, comment_id, members,
+                            comment_like_count)
+
+
+async def populate_db(db, args):
+    rng = random.Random(args.seed)
+    new_id = IdGenerator()
+    writer = BatchWriter(db, args.batch_size, args.concurrency)
+    start = time.perf_counter()
+
+    if args.drop:
+        for collection in ("users", "classes", "courses", "posts", "comments", "likes", "timelines", "versions", "events"):
+            await db[collection].drop()
+
+    hashed_password = await hash_password(args.password)
+    classes = [{"_id": new_id(BASE_TIMESTAMP), "name": f"Class {i + 1}", "user_ids": []}
+               for i in range(args.classes)]
+    courses = [{"_id": new_id(BASE_TIMESTAMP), "name": f"Course {i + 1}", "user_ids": []}
+               for i in range(args.courses)]
+    users = []
+    for i in range(args.users):
+        user = {"_id": new_id(BASE_TIMESTAMP), "username": f"user{i + 1}@example.com",
+                "hashed_password": hashed_password, "is_teacher": i < args.teachers,
+                "course_ids": [], "class_ids": []}
+        if classes:
+            a_class = rng.choice(classes)
+            user["class_ids"].append(a_class["_id"])
+            a_class["user_ids"].append(user["_id"])
+        for course in rng.sample(courses, min(args.courses_per_user, len(courses))):
+            user["course_ids"].append(course["_id"])
+            course["user_ids"].append(user["_id"])
+        users.append(user)
+
+    for collection, documents in (("users", users), ("classes", classes), ("courses", courses)):
+        for document in documents:
+            await writer.add(collection, document)
+
+    post_likes = zipf_cum_weights(args.max_likes_per_post, args.likes_zipf_exponent)
+    comment_likes = zipf_cum_weights(args.max_likes_per_comment, args.likes_zipf_exponent)
+    for a_class in classes:
+        await populate_wall(writer, rng, new_id, args, post_likes, comment_likes,
+                            "class_id", a_class["_id"], a_class["user_ids"])
+    for course in courses:
+        await populate_wall(writer, rng, new_id, args, post_likes, comment_likes,
+                            "course_id", course["_id"], course["user_ids"])
+
+    await writer.close()
+    await indexes.ensure_indexes(db)
+
+    seconds = time.perf_counter() - start
+    for collection, count in writer.written.items():
+        print(f"{collection}: {count}")
+    print(f"{sum(writer.written.values())} documents in {seconds:.1f} s")
 
 
-async def populate_db():
-    class1 = schemas.ClassCreate(name="1.B", user_ids=[])
-    class2 = schemas.ClassCreate(name="2.A", user_ids=[])
-
-    class1 = await crud.create_class(db, class1)
-    sleep(1)
-    class2 = await crud.create_class(db, class2)
-    sleep(1)
-
-
-    course1 = schemas.CourseCreate(name="Biology", user_ids=[])
-    course2 = schemas.CourseCreate(name="English", user_ids=[])
-    course3 = schemas.CourseCreate(name="Mathematics", user_ids=[])
-
-    course1 = await crud.create_course(db, course1)
-    sleep(1)
-    course2 = await crud.create_course(db, course2)
-    sleep(1)
-    course3 = await crud.create_course(db, course3)
-    sleep(1)
-
-    student1 = schemas.UserCreate(username="jiri.pap@gmail.com", password="", is_teacher=False)
-    student2 = schemas.UserCreate(username="chudovsky@mail.muni.cz", password="", is_teacher=False)
-    teacher1 = schemas.UserCreate(username="gesvindr@mail.muni.cz", password="", is_teacher=True)
-    teacher2 = schemas.UserCreate(username="jevocin@mail.muni.cz", password="", is_teacher=True)
-
-    student1 = await crud.create_user(db, student1)
-    sleep(1)
-    student2 = await crud.create_user(db, student2)
-    sleep(1)
-    teacher1 = await crud.create_user(db, teacher1)
-    sleep(1)
-    teacher2 = await crud.create_user(db, teacher2)
-    sleep(1)
-
-    student1, course1 = await crud.associate_user_course(db, student1, course1)
-    sleep(1)
-    student1, course2 = await crud.associate_user_course(db, student1, course2)
-    sleep(1)
-    student1, class1 = await crud.associate_user_class(db, student1, class1)
-    sleep(1)
-
-    student2, course2 = await crud.associate_user_course(db, student2, course2)
-    sleep(1)
-    student2, course3 = await crud.associate_user_course(db, student2, course3)
-    sleep(1)
-    student2, class1 = await crud.associate_user_class(db, student2, class1)
-    sleep(1)
-    student2, class2 = await crud.associate_user_class(db, student2, class2)
-    sleep(1)
-
-    teacher1, course1 = await crud.associate_user_course(db, teacher1, course1)
-    sleep(1)
-    teacher1, course2 = await crud.associate_user_course(db, teacher1, course2)
-    sleep(1)
-    teacher1, class1 = await crud.associate_user_class(db, teacher1, class1)
-    sleep(1)
-
-    teacher2, course3 = await crud.associate_user_course(db, teacher2, course3)
-    sleep(1)
-    teacher2, class2 = await crud.associate_user_class(db, teacher2, class2)
-
-asyncio.run(populate_db())
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--teachers", type=int, default=2)
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--courses", type=int, default=3)
+    parser.add_argument("--courses-per-user", type=int, default=2)
+    parser.add_argument("--posts-per-wall", type=int, default=10)
+    parser.add_argument("--comments-per-post", type=int, default=3, help="average number of comments per post")
+    parser.add_argument("--max-likes-per-post", type=int, default=1000)
+    parser.add_argument("--max-likes-per-comment", type=int, default=100)
+    parser.add_argument("--likes-zipf-exponent", type=float, default=2.0)
+    parser.add_argument("--days", type=int, default=365, help="time span the posts are spread over")
+    parser.add_argument("--password", default="", help="password of every generated user")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=4, help="number of batches inserted in parallel")
+    parser.add_argument("--drop", action="store_true", help="drop the existing collections first")
+    asyncio.run(populate_db(db, parser.parse_args()))
@@ -0,0 +1,177 @@
+"""Bulk import of users and their course/class enrollments from CSV.
+
+The CSV has a header row with the columns `username`, `password`, `is_teacher`,
+`course_ids` and `class_ids`; several IDs in one cell are separated by `;`.
+Users that already exist keep their password and are only enrolled.
+
+    python roster.py students.csv
+"""
+import asyncio
+import csv
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Iterable, Union
+
+from fastapi.encoders import jsonable_encoder
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import crud
+import schemas
+from cache import user_cache
+from database import db
+from passwords import hash_passwords
+
+
+ROSTER_CHUNK_SIZE = 1000
+TRUE_VALUES = {"1", "true", "yes", "y"}
+# comma separated usernames allowed to use POST /admin/roster; when empty, rosters can only be imported with this script
+ROSTER_ADMIN_USERNAMES = {username.strip() for username in os.getenv("ROSTER_ADMIN_USERNAMES", "").split(",")
+                          if username.strip()}
+
+
+class RosterRow:
+
+    def __init__(self, line: int, row: dict, importer: Union[str, None] = None):
+        self.line = line
+        self.username = (row.get("username") or "").strip()
+        if not self.username:
+            raise ValueError("Missing username")
+        self.password = row.get("password") or ""
+        self.is_teacher = (row.get("is_teacher") or "").strip().lower() in TRUE_VALUES
+        # imports over HTTP cannot create teachers or change the enrollments of the user making them
+        if importer is not None:
+            if self.is_teacher:
+                raise ValueError("Teachers can only be imported with roster.py")
+            if self.username == importer:
+                raise ValueError("The importing user's own enrollments cannot be changed")
+        self.course_ids = parse_ids(row.get("course_ids"))
+        self.class_ids = parse_ids(row.get("class_ids"))
+        self.hashed_password = None
+        self.user_id = None
+
+
+def parse_ids(value):
+    return [id.strip() for id in (value or "").split(";") if id.strip()]
+
+
+async def find_existing_ids(db, collection: str, ids: set[str]):
+    documents = await db[collection].find({"_id": {"$in": list(ids)}}, {"_id": 1}).to_list(len(ids))
+    return {document["_id"] for document in documents}
+
+
+async def write_users(db, rows: list[RosterRow], report: schemas.RosterImportReport):
+    existing_users = await db["users"].find({"username": {"$in": [row.username for row in rows]}},
+                                            {"username": 1}).to_list(len(rows))
+    existing_user_ids = {user["username"]: user["_id"] for user in existing_users}
+
+    new_rows = [row for row in rows if row.username not in existing_user_ids]
+    hashed_passwords = await hash_passwords([row.password for row in new_rows])
+    for row, hashed_password in zip(new_rows, hashed_passwords):
+        row.hashed_password = hashed_password
+
+    operations = []
+    for row in rows:
+        if row.username in existing_user_ids:
+            row.user_id = existing_user_ids[row.username]
+            operations.append(UpdateOne({"_id": row.user_id},
+                                        {"$addToSet": {"course_ids": {"$each": row.course_ids},
+                                                       "class_ids": {"$each": row.class_ids}}}))
+        else:
+            user = schemas.User(username=row.username, hashed_password=row.hashed_password,
+                                is_teacher=row.is_teacher, course_ids=row.course_ids, class_ids=row.class_ids)
+            row.user_id = str(user.id)
+            operations.append(InsertOne(jsonable_encoder(user)))
+
+    failed_indexes = set()
+    try:
+        await db["users"].bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            failed_indexes.add(error["index"])
+            report.errors.append(schemas.RosterImportError(line=rows[error["index"]].line, error=error["errmsg"]))
+
+    for username in existing_user_ids:
+        await user_cache.delete(username)
+    await crud.invalidate_timelines(db, list(existing_user_ids.values()))
+    return [row for index, row in enumerate(rows) if index not in failed_indexes]
+
+
+async def write_back_references(db, collection: str, user_ids_by_id: dict[str, list[str]]):
+    if user_ids_by_id:
+        await db[collection].bulk_write([UpdateOne({"_id": id}, {"$addToSet": {"user_ids": {"$each": user_ids}}})
+                                         for id, user_ids in user_ids_by_id.items()], ordered=False)
+
+
+async def import_chunk(db, rows: list[RosterRow], report: schemas.RosterImportReport):
+    known_course_ids = await find_existing_ids(db, "courses", {id for row in rows for id in row.course_ids})
+    known_class_ids = await find_existing_ids(db, "classes", {id for row in rows for id in row.class_ids})
+
+    valid_rows = []
+    for row in rows:
+        unknown_ids = [id for id in row.course_ids if id not in known_course_ids] + \
+                      [id for id in row.class_ids if id not in known_class_ids]
+        if unknown_ids:
+            report.errors.append(schemas.RosterImportError(line=row.line,
+                                                           error=f"Unknown course or class IDs: {', '.join(unknown_ids)}"))
+        else:
+            valid_rows.append(row)
+    if not valid_rows:
+        return
+
+    imported_rows = await write_users(db, valid_rows, report)
+
+    user_ids_by_course = defaultdict(list)
+    user_ids_by_class = defaultdict(list)
+    for row in imported_rows:
+        for course_id in row.course_ids:
+            user_ids_by_course[course_id].append(row.user_id)
+        for class_id in row.class_ids:
+            user_ids_by_class[class_id].append(row.user_id)
+    await write_back_references(db, "courses", user_ids_by_course)
+    await write_back_references(db, "classes", user_ids_by_class)
+    await crud.bump_versions(db, [crud.CATALOG_COURSES if user_ids_by_course else None,
+                                  crud.CATALOG_CLASSES if user_ids_by_class else None])
+    report.imported += len(imported_rows)
+
+
+def read_chunk(reader: csv.DictReader, chunk_size: int, report: schemas.RosterImportReport,
+               importer: Union[str, None]):
+    rows = []
+    for row in reader:
+        report.rows += 1
+        try:
+            rows.append(RosterRow(reader.line_num, row, importer))
+        except ValueError as e:
+            report.errors.append(schemas.RosterImportError(line=reader.line_num, error=str(e)))
+        if len(rows) >= chunk_size:
+            break
+    return rows
+
+
+async def import_roster(db, lines: Iterable[str], chunk_size: int = ROSTER_CHUNK_SIZE,
+                        importer: Union[str, None] = None):
+    report = schemas.RosterImportReport()
+    start = time.perf_counter()
+    reader = csv.DictReader(lines)
+    # reading the file blocks, so it happens in a thread
+    while rows := await asyncio.to_thread(read_chunk, reader, chunk_size, report, importer):
+        await import_chunk(db, rows, report)
+
+    report.errors.sort(key=lambda error: error.line)
+    report.seconds = time.perf_counter() - start
+    report.rows_per_second = report.rows / report.seconds if report.seconds else 0
+    return report
+
+
+async def main(path: str):
+    with open(path, newline="", encoding="utf-8") as roster_file:
+        report = await import_roster(db, roster_file)
+    print(report.json(indent=2))
+    return 1 if report.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(sys.argv[1])))
@@ -37,8 +37,6 @@ class User(BaseModel):
     is_teacher: bool = Field(...)
     course_ids: list[str] = Field(default_factory=list)
     class_ids: list[str] = Field(default_factory=list)
-    likes_post_ids: list[str] = Field(default_factory=list)
-    likes_comment_ids: list[str] = Field(default_factory=list)
 
     class Config:
         arbitrary_types_allowed = True
@@ -54,6 +52,19 @@ class UserPermissions(BaseModel):
     class_ids: list[str] = Field(default_factory=list)
 
     class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {ObjectId: str}
+
+
+class UserCredentials(BaseModel):
+
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    username: str = Field(...)
+    hashed_password: str = Field(...)
+
+    class Config:
+        allow_population_by_field_name = True
         arbitrary_types_allowed = True
         json_encoders = {ObjectId: str}
 
@@ -105,6 +116,17 @@ class Course(BaseModel):
         json_encoders = {ObjectId: str}
 
 
+class CatalogItem(BaseModel):
+
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    name: str = Field(...)
+
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {ObjectId: str}
+
+
 class CourseCreate(BaseModel):
     name: str = Field(...)
     user_ids: list[str] = Field(default_factory=list)
@@ -121,8 +143,21 @@ class Post(BaseModel):
     author_id: str = Field(...)
     course_id: str = Field(default=None)
     class_id: str = Field(default=None)
-    likes_user_ids: list[str] = Field(default_factory=list)
-    comment_ids: list[str] = Field(default_factory=list)
+    like_count: int = Field(default=0)
+    comment_count: int = Field(default=0)
+
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {ObjectId: str}
+
+
+class PostAccess(BaseModel):
+
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    author_id: str = Field(...)
+    course_id: str = Field(default=None)
+    class_id: str = Field(default=None)
 
     class Config:
         allow_population_by_field_name = True
@@ -136,7 +171,7 @@ class Comment(BaseModel):
     text: str = Field(...)
     author_id: str = Field(...)
     post_id: str = Field(...)
-    likes_user_ids: list[str] = Field(default_factory=list)
+    like_count: int = Field(default=0)
 
     class Config:
         allow_population_by_field_name = True
@@ -144,3 +179,76 @@ class Comment(BaseModel):
         json_encoders = {ObjectId: str}
 
 
+class CommentAccess(BaseModel):
+
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    author_id: str = Field(...)
+    post_id: str = Field(...)
+
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {ObjectId: str}
+
+
+class PostThread(Post):
+
+    comments: list[Comment] = Field(default_factory=list)
+
+
+class SearchResult(BaseModel):
+
+    id: str = Field(..., alias="_id")
+    # "post" or "comment"
+    type: str = Field(...)
+    post_id: str = Field(...)
+    scope_id: str = Field(...)
+    author_id: str = Field(...)
+    snippet: str = Field(...)
+    score: float = Field(...)
+
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {ObjectId: str}
+
+
+class Like(BaseModel):
+
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    user_id: str = Field(...)
+    target_type: str = Field(...)
+    target_id: str = Field(...)
+
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {ObjectId: str}
+
+
+class Timeline(BaseModel):
+
+    # the ID of the user the timeline belongs to
+    id: str = Field(..., alias="_id")
+    post_ids: list[str] = Field(default_factory=list)
+    fan_out_scope_ids: list[str] = Field(default_factory=list)
+    read_scope_ids: list[str] = Field(default_factory=list)
+    covers_from: Union[str, None] = Field(default=None)
+
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {ObjectId: str}
+
+
+class RosterImportError(BaseModel):
+    line: int = Field(...)
+    error: str = Field(...)
+
+
+class RosterImportReport(BaseModel):
+    rows: int = Field(default=0)
+    imported: int = Field(default=0)
+    errors: list[RosterImportError] = Field(default_factory=list)
+    seconds: float = Field(default=0)
+    rows_per_second: float = Field(default=0)
@@ -0,0 +1,49 @@
+from typing import Union
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+
+def default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, BaseModel):
+        return value.dict(by_alias=True)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default=default)
+
+
+class ORJSONResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def documents_response(documents: Union[dict, list[dict]], next_cursor=None, etag=None):
+    """Encode documents read from Mongo straight to bytes.
+
+    The documents are already projected to the fields of the route's response model,
+    so validating them again with pydantic and walking them with `jsonable_encoder`
+    would only repeat work; FastAPI skips both when a route returns a response.
+    """
+    response = ORJSONResponse(documents)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if etag is not None:
+        response.headers["ETag"] = etag
+    return response
+
+
+async def ndjson_lines(documents):
+    async for document in documents:
+        yield dumps(document) + b"\n"
+
+
+def ndjson_response(documents, filename: str):
+    return StreamingResponse(ndjson_lines(documents), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
@@ -0,0 +1,48 @@
+import html
+import os
+import re
+
+SNIPPET_LENGTH = int(os.getenv("SNIPPET_LENGTH", "160"))
+
+TERM = re.compile(r'"([^"]+)"|(\S+)')
+
+
+def search_terms(search: str):
+    """Split a `$text` search string into the phrases and words to highlight, skipping negated ones."""
+    terms = []
+    for phrase, word in TERM.findall(search):
+        if word.startswith("-"):
+            continue
+        words = re.findall(r"\w+", phrase or word)
+        if words:
+            terms.append(words)
+    return terms
+
+
+def terms_pattern(terms: list[list[str]]):
+    # words also match longer forms ("like" highlights "likes"), roughly following the stemming of the text index
+    alternatives = [r"\W+".join(re.escape(word) for word in words) + r"\w*" for words in terms]
+    return re.compile(r"\b(?:" + "|".join(alternatives) + ")", re.IGNORECASE)
+
+
+def make_snippet(text: str, terms: list[list[str]]):
+    """Cut the part of `text` around its first match and wrap the matches in `<mark>`; the rest is HTML-escaped."""
+    pattern = terms_pattern(terms) if terms else None
+    match = pattern.search(text) if pattern else None
+    start = 0
+    if match is not None and match.start() > SNIPPET_LENGTH // 3:
+        start = text.rfind(" ", 0, match.start() - SNIPPET_LENGTH // 3) + 1
+    end = min(len(text), start + SNIPPET_LENGTH)
+    if end < len(text) and " " in text[start:end]:
+        end = text.rfind(" ", start, end)
+
+    parts = ["…"] if start > 0 else []
+    position = start
+    for match in (pattern.finditer(text, start, end) if pattern else ()):
+        parts.append(html.escape(text[position:match.start()]))
+        parts.append("<mark>" + html.escape(match.group()) + "</mark>")
+        position = match.end()
+    parts.append(html.escape(text[position:end]))
+    if end < len(text):
+        parts.append("…")
+    return "".join(parts)
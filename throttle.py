@@ -0,0 +1,136 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+
+LOGIN_THROTTLE_WINDOW_SECONDS = float(os.getenv("LOGIN_THROTTLE_WINDOW_SECONDS", "300"))
+# failed logins allowed per window; 0 turns the limit off
+LOGIN_USERNAME_LIMIT = int(os.getenv("LOGIN_USERNAME_LIMIT", "10"))
+LOGIN_IP_LIMIT = int(os.getenv("LOGIN_IP_LIMIT", "300"))
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "100000"))
+# e.g. redis://localhost:6379/0; shares the counts between uvicorn workers, requires the `redis` package
+LOGIN_THROTTLE_REDIS_URL = os.getenv("LOGIN_THROTTLE_REDIS_URL")
+
+
+class MemoryWindowCounter:
+    """Sliding window counts approximated from two fixed windows.
+
+    The count of the previous window is weighted by how much of it still overlaps the
+    sliding window, so each key needs two numbers instead of a timestamp per hit.
+    """
+
+    def __init__(self, window: float, max_keys: int):
+        self.window = window
+        self.max_keys = max_keys
+        # key -> [index of the current window, hits in it, hits in the previous one]
+        self.entries = OrderedDict()
+
+    def current(self, key: str, index: float):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < index - 1:
+            return [index, 0, 0]
+        if entry[0] == index - 1:
+            return [index, 0, entry[1]]
+        return entry
+
+    async def hit(self, key: str, amount: int = 1):
+        """Adds `amount` to the key's count and returns the count; a negative amount takes hits back."""
+        index, offset = divmod(time.time(), self.window)
+        entry = self.current(key, index)
+        entry[1] = max(0, entry[1] + amount)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+        return entry[1] + entry[2] * (1 - offset / self.window)
+
+    async def reset(self, key: str):
+        self.entries.pop(key, None)
+
+    def stats(self):
+        return {"keys": len(self.entries)}
+
+
+class RedisWindowCounter:
+
+    def __init__(self, url: str, window: float, prefix: str):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url)
+        self.window = window
+        self.prefix = prefix
+
+    def keys(self, key: str, index: int):
+        return f"{self.prefix}{key}:{index}", f"{self.prefix}{key}:{index - 1}"
+
+    async def hit(self, key: str, amount: int = 1):
+        index, offset = divmod(time.time(), self.window)
+        current, previous = self.keys(key, int(index))
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.incrby(current, amount)
+            pipe.expire(current, math.ceil(2 * self.window))
+            pipe.get(previous)
+            count, _, previous_count = await pipe.execute()
+        return max(0, count) + int(previous_count or 0) * (1 - offset / self.window)
+
+    async def reset(self, key: str):
+        await self.redis.delete(*self.keys(key, int(time.time() // self.window)))
+
+    def stats(self):
+        return {}
+
+
+class LoginThrottle:
+    """Limits failed logins per username and per client address.
+
+    `check` counts every attempt as a failure before the password is checked, so a
+    concurrent burst cannot get more attempts to bcrypt than the limit allows, and a
+    rejected attempt costs no hash and no database query and is not counted.
+    `succeeded` takes the attempt back: a successful login clears its username's count
+    and does not use up the limit of a school address shared by many users.
+    """
+
+    def __init__(self, counter, username_limit: int, ip_limit: int):
+        self.counter = counter
+        self.username_limit = username_limit
+        self.ip_limit = ip_limit
+        self.rejected = 0
+
+    def limits(self, username: str, client_ip: str):
+        limits = []
+        if self.username_limit:
+            limits.append(("username:" + username.lower(), self.username_limit))
+        if self.ip_limit and client_ip:
+            limits.append(("ip:" + client_ip, self.ip_limit))
+        return limits
+
+    async def check(self, username: str, client_ip: str):
+        """Returns the seconds to wait if the username or the client failed too often, otherwise None."""
+        counted = []
+        for key, limit in self.limits(username, client_ip):
+            counted.append(key)
+            if await self.counter.hit(key) > limit:
+                for counted_key in counted:
+                    await self.counter.hit(counted_key, -1)
+                self.rejected += 1
+                window = self.counter.window
+                return max(1, math.ceil(window - time.time() % window))
+        return None
+
+    async def succeeded(self, username: str, client_ip: str):
+        if self.username_limit:
+            await self.counter.reset("username:" + username.lower())
+        if self.ip_limit and client_ip:
+            await self.counter.hit("ip:" + client_ip, -1)
+
+    def stats(self):
+        return {"rejected": self.rejected, **self.counter.stats()}
+
+
+if LOGIN_THROTTLE_REDIS_URL:
+    login_counter = RedisWindowCounter(LOGIN_THROTTLE_REDIS_URL, LOGIN_THROTTLE_WINDOW_SECONDS, prefix="login:")
+else:
+    login_counter = MemoryWindowCounter(LOGIN_THROTTLE_WINDOW_SECONDS, LOGIN_THROTTLE_MAX_KEYS)
+
+login_throttle = LoginThrottle(login_counter, LOGIN_USERNAME_LIMIT, LOGIN_IP_LIMIT)
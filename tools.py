@@ -1,17 +1,155 @@
 from azure.servicebus.aio import ServiceBusClient
 from azure.servicebus import ServiceBusMessage
+from azure.servicebus.exceptions import MessageSizeExceededError
 
+import asyncio
+import logging
 import os
+import time
 import schemas
+from collections import OrderedDict, deque
 
 SERVICE_BUS_CONN_STRING = os.getenv("CUSTOMCONNSTR_SERVICE_BUS")
+# "memory" keeps the last notifications in the process instead of sending them, for tests and benchmarks
+FAILED_AUTH_TRANSPORT = os.getenv("FAILED_AUTH_TRANSPORT", "servicebus")
+FAILED_AUTH_MEMORY_MESSAGES = int(os.getenv("FAILED_AUTH_MEMORY_MESSAGES", "1000"))
+FAILED_AUTH_QUEUE_NAME = "failed_auth"
+FAILED_AUTH_QUEUE_SIZE = int(os.getenv("FAILED_AUTH_QUEUE_SIZE", "10000"))
+FAILED_AUTH_BATCH_SIZE = int(os.getenv("FAILED_AUTH_BATCH_SIZE", "100"))
+# at most one notification per user in this many seconds
+FAILED_AUTH_COALESCE_SECONDS = float(os.getenv("FAILED_AUTH_COALESCE_SECONDS", "60"))
+POLL_INTERVAL_SECONDS = 0.5
 
+logger = logging.getLogger('uvicorn.error')
 
-async def send_failed_auth_message(user: schemas.User):
-    message = ServiceBusMessage(user.username)
-    async with ServiceBusClient.from_connection_string(
-            conn_str=SERVICE_BUS_CONN_STRING,
-            logging_enable=True) as servicebus_client:
-        sender = servicebus_client.get_queue_sender(queue_name="failed_auth")
-        async with sender:
-            await sender.send_messages(message)
+
+class ServiceBusTransport:
+
+    def __init__(self, conn_str: str, queue_name: str):
+        self.conn_str = conn_str
+        self.queue_name = queue_name
+        self.client = None
+        self.sender = None
+
+    async def start(self):
+        self.client = ServiceBusClient.from_connection_string(conn_str=self.conn_str, logging_enable=True)
+        self.sender = self.client.get_queue_sender(queue_name=self.queue_name)
+
+    async def send(self, bodies: list[str]):
+        batch = await self.sender.create_message_batch()
+        for body in bodies:
+            message = ServiceBusMessage(body)
+            try:
+                batch.add_message(message)
+            except MessageSizeExceededError:
+                await self.sender.send_messages(batch)
+                batch = await self.sender.create_message_batch()
+                batch.add_message(message)
+        await self.sender.send_messages(batch)
+
+    async def close(self):
+        await self.sender.close()
+        await self.client.close()
+
+
+class InMemoryTransport:
+
+    def __init__(self, max_messages: int):
+        self.messages = deque(maxlen=max_messages)
+
+    async def start(self):
+        pass
+
+    async def send(self, bodies: list[str]):
+        self.messages.extend(bodies)
+
+    async def close(self):
+        pass
+
+
+class FailedAuthPublisher:
+
+    def __init__(self, transport, queue_size: int, batch_size: int, coalesce_seconds: float):
+        self.transport = transport
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.coalesce_seconds = coalesce_seconds
+        # created by start, on the event loop that serves the requests
+        self.queue = None
+        self.stopping = None
+        # username -> when its last notification was queued, oldest first
+        self.recent = OrderedDict()
+        self.task = None
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def publish(self, user: schemas.User):
+        now = time.monotonic()
+        while self.recent and next(iter(self.recent.values())) < now - self.coalesce_seconds:
+            self.recent.popitem(last=False)
+        if user.username in self.recent:
+            self.coalesced += 1
+            return
+        if self.queue is None:
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(user.username)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self.recent[user.username] = now
+        self.enqueued += 1
+
+    async def start(self):
+        if self.transport is None:
+            logger.warning("CUSTOMCONNSTR_SERVICE_BUS is not set, failed login notifications are not sent")
+            return
+        await self.transport.start()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.stopping = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.stopping.set()
+        await self.task
+        await self.transport.close()
+
+    async def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                bodies = [await asyncio.wait_for(self.queue.get(), POLL_INTERVAL_SECONDS)]
+            except asyncio.TimeoutError:
+                continue
+            while len(bodies) < self.batch_size and not self.queue.empty():
+                bodies.append(self.queue.get_nowait())
+            await self.flush(bodies)
+
+    async def flush(self, bodies: list[str]):
+        try:
+            await self.transport.send(bodies)
+        except Exception:
+            self.failed += len(bodies)
+            logger.exception("Failed to publish %d failed authentication messages", len(bodies))
+            return
+        self.sent += len(bodies)
+
+    def stats(self):
+        return {"queued": self.queue.qsize() if self.queue is not None else 0, "enqueued": self.enqueued,
+                "sent": self.sent, "dropped": self.dropped, "failed": self.failed, "coalesced": self.coalesced}
+
+
+if FAILED_AUTH_TRANSPORT == "memory":
+    failed_auth_transport = InMemoryTransport(FAILED_AUTH_MEMORY_MESSAGES)
+elif SERVICE_BUS_CONN_STRING:
+    failed_auth_transport = ServiceBusTransport(SERVICE_BUS_CONN_STRING, FAILED_AUTH_QUEUE_NAME)
+else:
+    failed_auth_transport = None
+
+failed_auth_publisher = FailedAuthPublisher(failed_auth_transport, FAILED_AUTH_QUEUE_SIZE, FAILED_AUTH_BATCH_SIZE,
+                                            FAILED_AUTH_COALESCE_SECONDS)